@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+import subprocess
+import statistics
+import argparse
+import platform
+import random
+import json
+import time
+import sys
+import re
+
+# python bench.py                         运行全部基准测试，结果保存到 bench-<提交号>.json
+# python bench.py -k html                 只运行名字包含 html 的
+# python bench.py --compare bench-old.json  和之前保存的结果对比
+
+benchmarks = []
+
+def benchmark(name, number=None):
+    '''注册一个基准测试
+
+    被装饰的函数负责准备数据，返回真正要计时的无参函数；
+    准备过程中 ImportError 会被当作跳过（例如没有安装 PySide2 或 requests）
+    '''
+    def decorator(setup):
+        benchmarks.append((name, setup, number))
+        return setup
+    return decorator
+
+def make_history(count, seed=0):
+    '构造 gethistory 返回的 room 列表'
+    rng = random.Random(seed)
+    now = int(time.time())
+    room = []
+    for i in range(count):
+        ts = now - count + i
+        medal = []
+        if rng.random() < 0.6:
+            medal = [rng.randint(1, 40), rng.choice(['小彭', '老师', '粉丝团']), '主播', 75287, 0, '', 0, 0, 0, 0, 0, rng.randint(0, 1)]
+        room.append({
+            'text': rng.choice(['666', '主播好', '这个问题怎么解决？', '哈哈哈哈哈哈', 'C++ 的模板元编程' * rng.randint(1, 3)]),
+            'uid': rng.randint(1, 10 ** 9),
+            'nickname': f'用户{rng.randint(1, 99999)}',
+            'timeline': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)),
+            'id_str': f'{ts}{i:08d}',
+            'medal': medal,
+            'check_info': {'ts': ts, 'ct': f'{i:08X}'},
+        })
+    return room
+
+def make_messages(count):
+    from msgstore import DanmuMessage
+    return [DanmuMessage.from_history(m) for m in make_history(count)]
+
+def make_pairs(count):
+    return [m.display(True, True) for m in make_messages(count)]
+
+for count in (10, 100, 10000):
+    @benchmark(f'messages_to_html[{count}]')
+    def _(count=count):
+        from danmu import messages_to_html
+        messages = make_pairs(count)
+        return lambda: messages_to_html(messages)
+
+@benchmark('get_messages.parse[10]')
+def _():
+    from msgstore import DanmuMessage
+    body = json.dumps({'code': 0, 'message': '0', 'data': {'admin': [], 'room': make_history(10)}})
+    return lambda: [DanmuMessage.from_history(m) for m in json.loads(body)['data']['room']]
+
+@benchmark('DanmuMessage.display[100]')
+def _():
+    messages = make_messages(100)
+
+    def run():
+        # 勋章和时间都显示；清掉缓存，测的是格式化本身而不是缓存命中
+        for m in messages:
+            m.display_cache = None
+            m.display(True, True)
+    return run
+
+@benchmark('DanmuMessage.display.cached[100]')
+def _():
+    messages = make_messages(100)
+    return lambda: [m.display(True, True) for m in messages]
+
+@benchmark('DanmuFileSink.format[10]')
+def _():
+    from danmufile import DanmuFileSink
+    sink = DanmuFileSink('', '{danmu}\n[B站弹幕有屏蔽词，没显示就是叔叔屏蔽了]', max_lines=10)
+    messages = make_pairs(100)
+    return lambda: sink.format(messages)
+
+@benchmark('current_music.regex[200]')
+def _():
+    from nowplaying import NowPlaying
+    rng = random.Random(0)
+    titles = [f'{rng.choice(["终端", "Visual Studio Code", "Mozilla Firefox", "文件管理器"])} - {i}' for i in range(199)]
+    titles.append('Never Gonna Give You Up_哔哩哔哩_bilibili — Mozilla Firefox')
+    now_playing = NowPlaying('( - VLC media player|_哔哩哔哩_bilibili — Mozilla Firefox)$')
+    return lambda: now_playing.update_windows(titles)
+
+@benchmark('getMixinKey')
+def _():
+    from live import getMixinKey
+    orig = '7cd084941338484aae1ad9425b84077c' + '4932caff0ff746eab6f01bf08b70ac45'
+    return lambda: getMixinKey(orig)
+
+@benchmark('encWbi')
+def _():
+    from live import encWbi
+    params = {'foo': '114', 'bar': '514', 'zab': 1919810, 'mid': 75287}
+    return lambda: encWbi(dict(params), '7cd084941338484aae1ad9425b84077c', '4932caff0ff746eab6f01bf08b70ac45')
+
+def measure(func, number=None, repeat=7, min_time=0.2):
+    '类似 timeit：先找出一轮至少耗时 min_time 的调用次数，再重复 repeat 轮，返回每次调用的耗时'
+    if number is None:
+        number = 1
+        while True:
+            started = time.perf_counter()
+            for _ in range(number):
+                func()
+            if time.perf_counter() - started >= min_time:
+                break
+            number *= 2
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - started) / number)
+    return number, times
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.3g} {unit}'
+    return f'{seconds / 1e-9:.3g} ns'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='弹幕助手热点路径的基准测试')
+    parser.add_argument('-k', dest='pattern', help='只运行名字匹配该正则的测试')
+    parser.add_argument('-o', '--output', help='结果文件，默认 bench-<提交号>.json')
+    parser.add_argument('--compare', help='与之前保存的结果文件对比')
+    parser.add_argument('--repeat', type=int, default=7, help='每项重复轮数')
+    parser.add_argument('--min-time', type=float, default=0.2, help='每轮最少耗时（秒）')
+    args = parser.parse_args(argv)
+
+    revision = git_revision()
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = {r['name']: r for r in json.load(f)['results']}
+
+    results = []
+    for name, setup, number in benchmarks:
+        if args.pattern and not re.search(args.pattern, name):
+            continue
+        try:
+            func = setup()
+        except ImportError as e:
+            print(f'{name:<40} 跳过：{e}')
+            results.append({'name': name, 'skipped': str(e)})
+            continue
+        number, times = measure(func, number, args.repeat, args.min_time)
+        result = {
+            'name': name,
+            'number': number,
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        }
+        results.append(result)
+        line = f'{name:<40} {format_time(result["median"]):>10}  (min {format_time(result["min"])}, ±{format_time(result["stdev"])})'
+        old = baseline.get(name)
+        if old and 'median' in old:
+            line += f'  {result["median"] / old["median"]:.2f}x'
+        print(line)
+
+    output = args.output or f'bench-{revision}.json'
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'revision': revision,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存到 {output}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
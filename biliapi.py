@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import threading
+import os
+import re
+
+# 各个域名的连接池大小，弹幕轮询和发送都走 api.live，给它多留几个连接
+pool_sizes = {
+    'https://api.live.bilibili.com/': 4,
+    'https://api.bilibili.com/': 2,
+    'https://passport.bilibili.com/': 1,
+    'https://i0.hdslb.com/': 2,
+    'https://i1.hdslb.com/': 2,
+    'https://i2.hdslb.com/': 2,
+}
+
+# 设置环境变量 BILI_API_BASE=http://127.0.0.1:8000 后，所有 B 站接口都改发到这个地址，
+# 用于配合 mockbili.py 离线测试和压测
+api_base = os.environ.get('BILI_API_BASE', '').rstrip('/')
+
+BILI_HOST = re.compile(r'^https?://(?:(?:api\.live|api|passport|www)\.bilibili\.com|i\d\.hdslb\.com)(?=/)')
+
+def api_url(url):
+    '设置了 BILI_API_BASE 时把 B 站接口和图片的地址换成它'
+    if not api_base:
+        return url
+    return BILI_HOST.sub(api_base, url)
+
+class ApiError(RuntimeError):
+    '接口返回的 code 非零'
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+class BiliApi:
+    '''所有 B 站接口共用的 HTTP 客户端
+
+    复用 keep-alive 连接，统一设置超时、cookies 和 csrf 参数
+    '''
+    def __init__(self, headers, cookies, timeout=(5, 10)):
+        self.headers = headers
+        self.cookies = cookies
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.requests_session = None
+
+    @property
+    def session(self):
+        # requests 导入较慢，第一次发请求时才创建会话，不拖慢启动
+        if self.requests_session is None:
+            with self.lock:
+                if self.requests_session is None:
+                    import requests
+                    import requests.adapters
+                    session = requests.Session()
+                    session.headers.update(self.headers)
+                    session.cookies.update(self.cookies)
+                    for prefix, size in pool_sizes.items():
+                        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+                        session.mount(prefix, adapter)
+                    if api_base:
+                        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=sum(pool_sizes.values()))
+                        session.mount(api_base + '/', adapter)
+                    self.requests_session = session
+        return self.requests_session
+
+    def set_cookies(self, cookies):
+        self.cookies = cookies
+        if self.requests_session is not None:
+            self.requests_session.cookies.clear()
+            self.requests_session.cookies.update(cookies)
+
+    def csrf(self):
+        return self.session.cookies.get('bili_jct', '')
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, api_url(url), **kwargs)
+
+    def check(self, req):
+        data = req.json()
+        if data['code'] != 0:
+            raise ApiError(data['code'], data['message'])
+        return data['data']
+
+    def get(self, url, params=None):
+        '发送 GET 请求，返回响应中的 data 字段，code 非零时抛出 ApiError'
+        return self.check(self.request('GET', url, params=params))
+
+    def post(self, url, data):
+        '发送带 csrf 的表单 POST 请求，返回值同 get'
+        data = dict(data)
+        data['csrf'] = data['csrf_token'] = self.csrf()
+        return self.check(self.request('POST', url, data=data))
@@ -1,26 +1,55 @@
 #!/usr/bin/env python
 
-from PySide2.QtGui import QIcon, QPixmap, QImage, QColor
-from PySide2.QtCore import QPoint, QThread, QTimer, Qt, QEvent
-from PySide2.QtWidgets import QWidget, QLabel, QSystemTrayIcon, QPushButton, QMenu, QVBoxLayout, QHBoxLayout, QLineEdit, QComboBox, QSpinBox, QCheckBox, QTextEdit, QApplication, QColorDialog
-from PySide2.QtWebEngineWidgets import QWebEngineView, QWebEnginePage, QWebEngineSettings
+import time
+import sys
+startup_begin = time.perf_counter()
+
+if __name__ == '__main__' and sys.argv[1:2] == ['history']:
+    # python danmu.py history --user ... --since ... --grep ...，不需要加载 Qt
+    import history
+    sys.exit(history.main(sys.argv[2:]))
 
-import urllib.parse
+from PySide2.QtGui import QIcon, QPixmap, QImage, QColor, QFont, QPainter, QTextLayout, QTextCharFormat, QTextOption, QPainterPath
+from PySide2.QtCore import QObject, Signal, QPoint, QPointF, QRectF, QTimer, QUrl, Qt, QEvent
+from PySide2.QtWidgets import QWidget, QLabel, QSystemTrayIcon, QPushButton, QMenu, QVBoxLayout, QHBoxLayout, QLineEdit, QComboBox, QSpinBox, QCheckBox, QTextEdit, QPlainTextEdit, QApplication, QColorDialog
+
+import concurrent.futures
 import subprocess
 import traceback
 import threading
-import requests
+import atexit
 import hashlib
 import random
 import queue
 import json
 import html
-import time
-import sys
 import os
-import re
+
+from biliapi import BiliApi, ApiError
+from danmuws import DanmuClient
+from danmufile import DanmuFileSink, atomic_write
+from history import HistoryStore
+from imagecache import ImageCache
+import metrics
+from msgstore import DanmuMessage, MessageStore
+from nowplaying import NowPlaying
+from shield import ShieldWords
+
+profile_startup = '--profile-startup' in sys.argv
+startup_last = startup_begin
+
+def startup_phase(name):
+    '--profile-startup 时打印启动各阶段耗时'
+    global startup_last
+    if profile_startup:
+        now = time.perf_counter()
+        print(f'[启动] {name:<16} +{(now - startup_last) * 1000:7.1f} ms  累计 {(now - startup_begin) * 1000:7.1f} ms')
+        startup_last = now
+
+startup_phase('导入模块')
 
 try:
+    # 按源码内容计算版本，代码更新后重置设置；只是 touch、复制或重新检出时不变（读文件加 MD5 不到 1 毫秒）
     with open(os.path.realpath(__file__), 'rb') as f:
         current_version = hashlib.md5(f.read()).hexdigest()[:8]
 except:
@@ -50,9 +79,12 @@ if len(options) == 0 or options.get('version', 'undefined') != current_version:
         'version': current_version,
         'width': 450,
         'height': 180,
-        'refreshCountdown': 8,
-        'refreshInterval': 1,
-        'pollInterval': 4,
+        'minPollInterval': 1,
+        'maxPollInterval': 8,
+        'fetchMode': '轮询',
+        'renderer': '网页',
+        'connectTimeout': 5,
+        'readTimeout': 10,
         'fontFamily': 'Arial',
         'fontSize': 18,
         'usernameR': 117,
@@ -70,123 +102,373 @@ if len(options) == 0 or options.get('version', 'undefined') != current_version:
         'showMusicName': False,
         'showUserMedal': False,
         'showMsgTime': False,
+        'showImages': False,
+        'imageCacheDir': '.bilibili-images',
+        'imageMemoryBudget': 32,
+        'imageDiskBudget': 128,
         'customRoom': False,
         'customRoomId': 75287,
+        'extraRooms': '',
         'autoStartOBS': False,
         'bypassWindowManager': True,
         'startMinimized': False,
         # 'danmuFile': tempfile.gettempdir() + '/danmu.txt',
+        'sendInterval': 1.5,
         'danmuFile': '',
+        'danmuFileLines': 10,
+        'danmuFileInterval': 0.5,
+        'shieldFile': 'pinbi.txt',
+        'historyFile': '.bilibili-history.db',
+        'historyWhenHidden': False,
+        'metricsEnabled': False,
+        'metricsPort': 0,
         'danmuFormat': '{danmu}\n[B站弹幕有屏蔽词，没显示就是叔叔屏蔽了]\n[已知屏蔽词：小彭老师、皇帝卡、Electron]',
         'musicRegex': '( - VLC media player|_哔哩哔哩_bilibili — Mozilla Firefox)$',
     }
 
-def current_music():
-    titleRegex = options['musicRegex']
+startup_phase('读取设置')
+
+api = BiliApi(headers, cookies, timeout=(options['connectTimeout'], options['readTimeout']))
+# 头像和表情的地址来自弹幕内容，可能是任意域名甚至 http://，不能带上登录 cookies
+image_api = BiliApi(headers, {}, timeout=(options['connectTimeout'], options['readTimeout']))
+
+now_playing = NowPlaying(options['musicRegex'])
+
+shield_words = ShieldWords(options['shieldFile'])
+
+fetch_requests = metrics.Counter('danmu_fetch_requests_total', 'gethistory 请求次数', ['status'])
+fetch_seconds = metrics.Histogram('danmu_fetch_seconds', 'gethistory 请求耗时')
+messages_received = metrics.Counter('danmu_messages_received_total', '收到的弹幕条数（含重复）', ['source'])
+messages_new = metrics.Counter('danmu_messages_new_total', '去重后的新弹幕条数')
+updates_dropped = metrics.Counter('danmu_updates_dropped_total', '界面来不及显示、被更新的列表覆盖的弹幕列表次数')
+render_seconds = metrics.Histogram('danmu_render_seconds', 'update_messages 中刷新弹幕视图的耗时')
+music_seconds = metrics.Histogram('danmu_current_music_seconds', 'current_music 耗时')
+
+def apply_metrics_options():
+    metrics.enabled = options['metricsEnabled']
+    if not (metrics.enabled and options['metricsPort']):
+        metrics.stop_server()
+        return
     try:
-        try:
-            import pywinctl
-        except ImportError:
-            if sys.platform != 'linux':
-                return ''
-            with subprocess.Popen(['wmctrl', '-l'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as p:
-                stdout, _ = p.communicate()
-                stdout = stdout.decode()
-                title = ''
-                for line in stdout.splitlines():
-                    # 0x02000003  3 archer 终端
-                    m = re.match(r'^0x([0-9a-f]+)\s+(\d+)\s+(.*?)\s+(.*)$', line)
-                    if m:
-                        title = m.group(4).strip()
-                    if re.search(titleRegex, title):
-                        break
-                else:
-                    title = ''
-            if title:
-                title = re.sub(titleRegex, '', title)
-            title = title.strip()
-            if title.endswith('.mp4'):
-                title = title[:-len('.mp4')]
-            return title
-        else:
-            from ewmhlib import EwmhWindow
-            if EwmhWindow.getName.__name__ != 'ewmhFixedGetName':
-                def ewmhFixedGetName(self):
-                    from ewmhlib.Props._props import Window
-                    from ewmhlib import getPropertyValue
-                    ret = self.getProperty(Window.NAME)
-                    res = getPropertyValue(ret, display=self.display)
-                    if res:
-                        return ''.join(map(str, res))
-                    ret = self.getProperty(Window.LEGACY_NAME)
-                    res = getPropertyValue(ret, display=self.display)
-                    if res:
-                        return ''.join(map(str, res))
-                    return None
-                EwmhWindow.getName = ewmhFixedGetName
-            for win in pywinctl.getAllWindows():
-                if re.search(titleRegex, win.title):
-                    title = win.title
-                    if title:
-                        title = re.sub(titleRegex, '', title)
-                        title = title.strip()
-                        if title.endswith('.mp4'):
-                            title = title[:-len('.mp4')]
-                        return title
-    except:
+        metrics.start_server(options['metricsPort'])
+    except OSError:
         traceback.print_exc()
-        return ''
 
-def messages_to_html(messages: list[tuple[str, str]]) -> str:
+apply_metrics_options()
+
+def current_music():
+    started = time.perf_counter()
+    now_playing.start()
+    title = now_playing.get()
+    music_seconds.observe(time.perf_counter() - started)
+    return title
+
+def style_vars() -> dict[str, str]:
+    return {
+        '--background': f"rgba({options['backgroundR']}, {options['backgroundG']}, {options['backgroundB']}, {options['backgroundOpacity']})",
+        '--username': f"rgba({options['usernameR']}, {options['usernameG']}, {options['usernameB']}, {options['foregroundOpacity']})",
+        '--message': f"rgba({options['messageR']}, {options['messageG']}, {options['messageB']}, {options['foregroundOpacity']})",
+        '--font-family': options['fontFamily'],
+        '--font-size': f"{options['fontSize']}px",
+        '--foreground-opacity': str(options['foregroundOpacity']),
+    }
+
+style_keys = {'backgroundR', 'backgroundG', 'backgroundB', 'backgroundOpacity',
+              'usernameR', 'usernameG', 'usernameB', 'messageR', 'messageG', 'messageB',
+              'foregroundOpacity', 'fontFamily', 'fontSize'}
+
+def messages_to_html(messages: list[tuple[str, ...]]) -> str:
     content = '<html><head><meta charset="utf-8">'
-    content += f'''<style>
-body {{
+    content += '<style>\n:root {\n'
+    content += ''.join(f'{k}: {v};\n' for k, v in style_vars().items())
+    content += '''}
+body {
 padding: 0;
 margin: 0px;
-}}
-div#container {{
+}
+div#container {
 border-radius: 10px;
 padding: 0;
-background-color: rgba({options['backgroundR']}, {options['backgroundG']}, {options['backgroundB']}, {options['backgroundOpacity']});
+background-color: var(--background);
 margin: 0 auto;
 height: 100%;
 width: 100%;
 overflow-y: scroll;
-}}
-span {{
-font-family: {options['fontFamily']};
-font-size: {options['fontSize']}px;
-}}
-span.username {{
-color: rgba({options['usernameR']}, {options['usernameG']}, {options['usernameB']}, {options['foregroundOpacity']});
-}}
-span.message {{
+}
+span {
+font-family: var(--font-family);
+font-size: var(--font-size);
+}
+span.username {
+color: var(--username);
+}
+span.message {
 color: #A2A7AE;
-color: rgba({options['messageR']}, {options['messageG']}, {options['messageB']}, {options['foregroundOpacity']});
-}}
-</style>'''
+color: var(--message);
+}
+div.shielded span.message {
+text-decoration: line-through;
+}
+img {
+opacity: var(--foreground-opacity);
+background-color: rgba(128, 128, 128, 0.3);
+}
+img[src] {
+background-color: transparent;
+}
+img.face {
+width: var(--font-size);
+height: var(--font-size);
+border-radius: 50%;
+margin-right: 4px;
+vertical-align: middle;
+}
+img.emoticon {
+height: calc(var(--font-size) * 3);
+min-width: calc(var(--font-size) * 3);
+vertical-align: bottom;
+}
+</style>
+<script>
+function makeImage(className, url, images) {
+    var img = document.createElement("img");
+    img.className = className;
+    img.setAttribute("data-src", url);
+    if (images && images[url])
+        img.src = images[url];
+    return img;
+}
+function makeMessage(m, images) {
+    var div = document.createElement("div");
+    div.className = m.length > 2 && m[2] ? "message " + m[2] : "message";
+    if (m.length > 3 && m[3])
+        div.appendChild(makeImage("face", m[3], images));
+    var username = document.createElement("span");
+    username.className = "username";
+    username.textContent = m[0] + " :";
+    div.appendChild(username);
+    if (m.length > 4 && m[4]) {
+        var emoticon = makeImage("emoticon", m[4], images);
+        emoticon.title = m[1];
+        div.appendChild(emoticon);
+        return div;
+    }
+    var message = document.createElement("span");
+    message.className = "message";
+    message.textContent = m[1];
+    div.appendChild(message);
+    return div;
+}
+function patchMessages(removeHead, removeTail, append, images) {
+    var container = document.getElementById("container");
+    for (var i = 0; i < removeHead && container.firstChild; i++)
+        container.removeChild(container.firstChild);
+    for (var i = 0; i < removeTail && container.lastChild; i++)
+        container.removeChild(container.lastChild);
+    for (var i = 0; i < append.length; i++)
+        container.appendChild(makeMessage(append[i], images));
+    if (container.lastChild)
+        container.lastChild.scrollIntoView(false);
+}
+function setImages(images) {
+    var imgs = document.querySelectorAll("img[data-src]");
+    for (var i = 0; i < imgs.length; i++) {
+        var src = images[imgs[i].getAttribute("data-src")];
+        if (src && imgs[i].src != src)
+            imgs[i].src = src;
+    }
+}
+function setStyle(vars) {
+    for (var k in vars)
+        document.documentElement.style.setProperty(k, vars[k]);
+}
+</script>'''
     content += '</head><body><div id="container">'
-    for i, (username, message) in enumerate(messages):
-        content += f'<div id="m{i}" class="message">'
+    for username, message, *extra in messages:
+        cssclass, face, emoticon = (list(extra) + ['', '', ''])[:3]
+        content += '<div class="' + ' '.join(['message'] + ([cssclass] if cssclass else [])) + '">'
+        if face:
+            content += '<img class="face" data-src="' + html.escape(face) + '">'
         content += f'<span class="username">' + html.escape(username) + ' :</span>'
-        content += f'<span class="message">' + html.escape(message) + '</span>'
+        if emoticon:
+            content += '<img class="emoticon" data-src="' + html.escape(emoticon) + '" title="' + html.escape(message) + '">'
+        else:
+            content += f'<span class="message">' + html.escape(message) + '</span>'
         content += '</div>'
+    content += '</div>'
     if len(messages) != 0:
-        content += f'''<script>
-document.getElementById("m{len(messages) - 1}").scrollIntoView(false)
+        content += '''<script>
+document.getElementById("container").lastChild.scrollIntoView(false)
 </script>'''
-    content += '</div></body></html>'
+    content += '</body></html>'
     return content
 
-class MyThread(QThread):
-    def __init__(self, parent, func, *args, **kwargs):
+def diff_messages(old: list, new: list) -> tuple[int, int, list]:
+    '''计算从 old 变为 new 所需的最少 DOM 操作
+
+    返回 (从头部删除条数, 从尾部删除条数, 追加的消息)，
+    弹幕列表通常只是头部滚出、尾部追加，只传输变化的部分
+    '''
+    best = (len(old), 0, new)
+    best_cost = len(old) + len(new)
+    for head in range(len(old)):
+        rest = old[head:]
+        common = 0
+        while common < len(rest) and common < len(new) and rest[common] == new[common]:
+            common += 1
+        cost = head + len(rest) - common + len(new) - common
+        if cost < best_cost:
+            best = (head, len(rest) - common, new[common:])
+            best_cost = cost
+    return best
+
+class PollScheduler:
+    '''根据弹幕到达速率自适应调整轮询间隔
+
+    间隔取为预计攒够 target * window 条新弹幕所需的时间；
+    一次轮询返回的 window 条全是新弹幕时，说明两次轮询之间可能漏了弹幕，立即减半。
+    当前间隔和速率保存在 interval、rate 中，可用于调试
+    '''
+    def __init__(self, min_interval, max_interval, window=10, target=0.5, smoothing=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.window = window
+        self.target = target
+        self.smoothing = smoothing
+        self.interval = min_interval
+        self.rate = 0.0
+        self.last_poll = None
+
+    def update(self, new_count) -> float:
+        now = time.monotonic()
+        if self.last_poll is None:
+            # 第一次轮询的弹幕都是“新”的，不计入速率
+            self.last_poll = now
+            return self.interval
+        elapsed = max(now - self.last_poll, 1e-3)
+        self.last_poll = now
+        self.rate += self.smoothing * (new_count / elapsed - self.rate)
+        if new_count >= self.window:
+            interval = self.interval / 2
+        elif self.rate > 0:
+            interval = self.target * self.window / self.rate
+        else:
+            interval = self.max_interval
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        return self.interval
+
+    def __repr__(self):
+        return f'PollScheduler(interval={self.interval:.2f}s, rate={self.rate:.2f}/s)'
+
+class RoomFeed:
+    '一个直播间的弹幕来源：消息存储、轮询调度，长连接模式下还有一个 DanmuClient'
+    def __init__(self, roomid):
+        self.roomid = roomid
+        self.store = MessageStore()
+        self.scheduler = PollScheduler(options['minPollInterval'], options['maxPollInterval'])
+        self.client = None
+        self.next_poll = 0.0
+
+    def __repr__(self):
+        return f'RoomFeed({self.roomid}, {self.scheduler})'
+
+def merge_feeds(feeds, count, show_medal, show_time) -> list[tuple[str, str, DanmuMessage]]:
+    '取各直播间最新的弹幕按时间合并，关注多个直播间时在用户名前加上直播间号'
+    if len(feeds) == 1:
+        return [m.display(show_medal, show_time) + (m,) for m in feeds[0].store.latest(count)]
+    merged = []
+    for feed in feeds:
+        merged.extend((m.timestamp, i, feed.roomid, m) for i, m in enumerate(feed.store.latest(count)))
+    merged.sort(key=lambda item: item[:2])
+    messages = []
+    for _, _, roomid, m in merged[-count:]:
+        user, text = m.display(show_medal, show_time)
+        messages.append((f'[{roomid}] {user}', text, m))
+    return messages
+
+class DanmuSender(QObject):
+    '''在后台线程中依次发送弹幕，不阻塞 GUI 线程
+
+    同一直播间两次发送至少间隔 sendInterval 秒，遇到发送过快的错误时退避重试。
+    发送结果通过 status 信号（弹幕, 状态, 说明）通知界面，状态为 sending、retrying、sent 或 failed
+    '''
+    status = Signal(str, str, str)
+
+    # 发送过快时接口返回的错误码
+    rate_limit_codes = {10030, 10031}
+
+    def __init__(self, parent=None, max_retries=5):
         super().__init__(parent)
-        self.func = func
-        self.args = args
-        self.kwargs = kwargs
+        self.max_retries = max_retries
+        self.queue = queue.Queue()
+        self.last_sent = {}
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def send(self, roomid, text):
+        '加入发送队列，roomid 为 None 时发送到自己的直播间'
+        self.queue.put((roomid, text))
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def worker(self):
+        while True:
+            roomid, text = self.queue.get()
+            self.status.emit(text, 'sending', '')
+            delay = options['sendInterval']
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if roomid is None:
+                        roomid = get_roomid()
+                    wait = self.last_sent.get(roomid, 0) + options['sendInterval'] - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    self.last_sent[roomid] = time.monotonic()
+                    send_message(roomid, text)
+                except ApiError as e:
+                    if e.code in self.rate_limit_codes or '频率' in str(e):
+                        if attempt < self.max_retries:
+                            self.status.emit(text, 'retrying', str(e))
+                            time.sleep(delay)
+                            delay *= 2
+                            continue
+                    self.status.emit(text, 'failed', str(e))
+                except Exception as e:
+                    traceback.print_exc()
+                    self.status.emit(text, 'failed', str(e))
+                else:
+                    self.status.emit(text, 'sent', '')
+                break
+
+class TaskRunner(QObject):
+    '''界面上所有会阻塞的操作（网络请求、启动子进程）共用的线程池
 
-    def run(self):
-        self.func(*self.args, **self.kwargs)
+    submit() 立即返回 Future，任务完成后在 GUI 线程中调用 on_result(结果) 或 on_error(异常)
+    '''
+    done = Signal(object)
+
+    def __init__(self, parent=None, max_workers=4):
+        super().__init__(parent)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+        self.done.connect(self.on_done)
+
+    def submit(self, func, *args, on_result=None, on_error=None):
+        future = self.pool.submit(func, *args)
+        future.add_done_callback(lambda future: self.done.emit((future, on_result, on_error)))
+        return future
+
+    def on_done(self, item):
+        future, on_result, on_error = item
+        error = future.exception()
+        if error is not None:
+            if on_error is not None:
+                on_error(error)
+            else:
+                traceback.print_exception(type(error), error, error.__traceback__)
+        elif on_result is not None:
+            on_result(future.result())
+
+tasks = None
 
 class LoginWindow(QWidget):
     def __init__(self, parent=None):
@@ -215,11 +497,12 @@ class LoginWindow(QWidget):
 
     def login(self):
         self.clear_login()
-        t = MyThread(self, self.get_qrcode)
-        t.finished.connect(self.show_qrcode)
-        t.start()
+        tasks.submit(self.get_qrcode, on_result=lambda _: self.show_qrcode(), on_error=self.on_qrcode_error)
         self.label.setText('正在生成二维码...')
 
+    def on_qrcode_error(self, error):
+        self.label.setText(f'生成二维码失败：{error}')
+
     def clear_login(self):
         self.qr_url = None
         self.qrcode_key = None
@@ -228,12 +511,10 @@ class LoginWindow(QWidget):
         self.image.setPixmap(QPixmap('icon.png').scaled(400, 400, Qt.KeepAspectRatio))
 
     def get_qrcode(self):
-        url = 'https://passport.bilibili.com/x/passport-login/web/qrcode/generate'
-        req = requests.get(url, headers=headers)
-        cookies.update(req.cookies.get_dict())
-        data = json.loads(req.text)
-        self.qr_url = data['data']['url']
-        self.qrcode_key = data['data']['qrcode_key']
+        data = api.get('https://passport.bilibili.com/x/passport-login/web/qrcode/generate')
+        cookies.update(api.session.cookies.get_dict())
+        self.qr_url = data['url']
+        self.qrcode_key = data['qrcode_key']
         self.status = '请在手机App上扫描二维码'
 
     def show_qrcode(self):
@@ -251,24 +532,28 @@ class LoginWindow(QWidget):
             self.clear_login()
         if self.isHidden() or self.succeeded:
             return
-        t = MyThread(self, self.poll_qrcode)
-        t.finished.connect(self.show_qrcode)
-        t.start()
+        QTimer.singleShot(3000, self.start_poll)
+
+    def start_poll(self):
+        if self.qrcode_key is None:
+            return
+        tasks.submit(self.poll_qrcode, on_result=lambda _: self.show_qrcode(), on_error=self.on_poll_error)
+
+    def on_poll_error(self, error):
+        # 网络波动时继续轮询
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.show_qrcode()
 
     def poll_qrcode(self):
-        time.sleep(3)
         url = f'https://passport.bilibili.com/x/passport-login/web/qrcode/poll?qrcode_key={self.qrcode_key}'
-        req = requests.get(url, headers=headers, cookies=cookies)
-        # print(req.text, req.cookies.get_dict())
-        cookies.update(req.cookies.get_dict())
-        data = json.loads(req.text)
-        data = data['data']
+        data = api.get(url)
+        # print(data, api.session.cookies.get_dict())
+        cookies.update(api.session.cookies.get_dict())
         if data['code'] == 0:
-            with open('.bilibili-cookies.json', 'w') as f:
-                json.dump(cookies, f)
-            del options['roomId']
-            with open('.bilibili-options.json', 'w') as f:
-                json.dump(options, f)
+            atomic_write('.bilibili-cookies.json', json.dumps(cookies).encode())
+            options.pop('roomId', None)
+            options_writer.mark_dirty('roomId')
+            options_writer.flush()
             self.status = '登录成功'
             self.succeeded = True
         elif data['code'] == 86038:
@@ -285,18 +570,8 @@ def get_roomid():
     if len(cookies) == 0:
         return 0
     if 'roomId' not in options:
-        url = 'https://api.bilibili.com/x/web-interface/nav'
-        req = requests.get(url, headers=headers, cookies=cookies)
-        data = json.loads(req.text)
-        if data['code'] != 0:
-            raise RuntimeError(data['message'])
-        mid = json.loads(req.text)['data']['mid']
-        url = f'https://api.live.bilibili.com/room/v1/Room/getRoomInfoOld?mid={mid}'
-        req = requests.get(url, headers=headers, cookies=cookies)
-        data = json.loads(req.text)
-        if data['code'] != 0:
-            raise RuntimeError(data['message'])
-        data = data['data']
+        mid = get_my_uid()
+        data = api.get(f'https://api.live.bilibili.com/room/v1/Room/getRoomInfoOld?mid={mid}')
         roomid = data['roomid']
         # print(f'已进入直播间 {data['title']} ({roomid})')
         set_option('roomId', roomid)
@@ -305,122 +580,157 @@ def get_roomid():
     # roomid = 75287
     return roomid
 
-def get_messages(roomid) -> list[tuple[str, str]]:
-    if len(cookies) == 0:
-        return [('提示', '未登录，请先点击托盘图标，在设置中扫码登录您的B站账号')]
-    if roomid == 0:
-        return [('提示', '直播间不存在')]
-    url = f'https://api.live.bilibili.com/xlive/web-room/v1/dM/gethistory?roomid={roomid}'
-    req = requests.get(url, headers=headers, cookies=cookies)
-    data = json.loads(req.text)
-    messages = data['data']['room']
-    res = []
-    for m in messages:
-        user = m['nickname']
-        text = m['text']
-        if options['showUserMedal']:
-            medal = m['medal']
-            if medal and medal[11]:
-                user = f'[{medal[0]}|{medal[1]}] {user}'
-        if options['showMsgTime']:
-            timeline = m['timeline']
-            user = f'{timeline.split()[1]} {user}'
-        res.append((user, text))
-    return res
+def get_watch_roomids() -> list[int]:
+    '需要显示弹幕的直播间：自己的（或 customRoomId 指定的）直播间，加上 extraRooms 中的其他直播间'
+    roomids = [options['customRoomId'] if options['customRoom'] else get_roomid()]
+    for roomid in options['extraRooms'].replace('，', ',').split(','):
+        roomid = roomid.strip()
+        if roomid.isdigit() and int(roomid) not in roomids:
+            roomids.append(int(roomid))
+    return [roomid for roomid in roomids if roomid != 0]
+
+def get_my_uid():
+    global my_uid
+    if my_uid is None:
+        my_uid = api.get('https://api.bilibili.com/x/web-interface/nav')['mid']
+    return my_uid
+
+my_uid = None
+
+def get_danmu_info(roomid):
+    data = api.get(f'https://api.live.bilibili.com/xlive/web-room/v1/index/getDanmuInfo?id={roomid}&type=0')
+    host = data['host_list'][0]
+    return host['host'], host['port'], data['token']
+
+def get_history(roomid) -> list[dict]:
+    return api.get(f'https://api.live.bilibili.com/xlive/web-room/v1/dM/gethistory?roomid={roomid}')['room']
+
+def fetch_image(url) -> bytes:
+    req = image_api.request('GET', url)
+    req.raise_for_status()
+    return req.content
+
+def get_messages(roomid) -> list[DanmuMessage]:
+    started = time.perf_counter()
+    try:
+        history = get_history(roomid)
+    except ApiError as e:
+        fetch_requests.inc(status=e.code)
+        raise
+    except Exception:
+        fetch_requests.inc(status='error')
+        raise
+    fetch_seconds.observe(time.perf_counter() - started)
+    fetch_requests.inc(status='ok')
+    messages_received.inc(len(history), source='poll')
+    return [DanmuMessage.from_history(m) for m in history]
 
 def list_live_areas():
-    url = f'https://api.live.bilibili.com/room/v1/Area/getList'
-    req = requests.get(url, headers=headers, cookies=cookies)
-    data = json.loads(req.text)
-    if data['code'] != 0:
-        raise RuntimeError(data['message'])
-    data = data['data']
-    return data
+    return api.get('https://api.live.bilibili.com/room/v1/Area/getList')
 
 def get_live_info(roomid):
     assert roomid != 0 and len(cookies) != 0
-    url = f'https://api.live.bilibili.com/room/v1/Room/get_info?room_id={roomid}'
-    req = requests.get(url, headers=headers, cookies=cookies)
-    data = json.loads(req.text)['data']
-    return data
+    return api.get(f'https://api.live.bilibili.com/room/v1/Room/get_info?room_id={roomid}')
 
 def send_message(roomid, text):
     assert roomid != 0 and len(text) != 0
-    url = 'https://api.live.bilibili.com/msg/send'
-    data = {
+    words = shield_words.search(text)
+    if words:
+        # 含屏蔽词的弹幕发送后会被静默吞掉，不如直接提示
+        raise RuntimeError(f'弹幕包含屏蔽词：{"、".join(words)}')
+    api.post('https://api.live.bilibili.com/msg/send', {
         'roomid': roomid,
         'msg': text,
         'mode': 1,
         'color': 0xffffff,
         'fontsize': 25,
         'rnd': random.randint(1, 0xffffffff),
-        'csrf': cookies['bili_jct'],
-        'csrf_token': cookies['bili_jct'],
-    }
-    data = urllib.parse.urlencode(data)
-    headers_ex = dict(headers)
-    headers_ex.update({'Content-Type': 'application/x-www-form-urlencoded'})
-    req = requests.post(url, data=data, headers=headers_ex, cookies=cookies)
-    data = json.loads(req.text)
-    if data['code'] != 0:
-        raise RuntimeError(data['message'])
+    })
 
 def set_live_title(roomid, title):
     assert roomid != 0 and len(cookies) != 0
-    url = 'https://api.live.bilibili.com/room/v1/Room/update'
-    data = {
+    api.post('https://api.live.bilibili.com/room/v1/Room/update', {
         'room_id': str(roomid),
         'title': title,
-        'csrf': cookies['bili_jct'],
-        'csrf_token': cookies['bili_jct'],
-    }
-    data = urllib.parse.urlencode(data)
-    headers_ex = dict(headers)
-    headers_ex.update({'Content-Type': 'application/x-www-form-urlencoded'})
-    req = requests.post(url, data=data, headers=headers_ex, cookies=cookies)
-    data = json.loads(req.text)
-    if data['code'] != 0:
-        raise RuntimeError(data['message'])
+    })
 
 def start_live(roomid, area):
     if area == 0:
         return None
     assert roomid != 0 and len(cookies) != 0
-    url = 'https://api.live.bilibili.com/room/v1/Room/startLive'
-    data = {
+    data = api.post('https://api.live.bilibili.com/room/v1/Room/startLive', {
         'room_id': str(roomid),
         'area_v2': str(area),
         'platform': 'pc',
-        'csrf': cookies['bili_jct'],
-    }
-    data = urllib.parse.urlencode(data)
-    headers_ex = dict(headers)
-    headers_ex.update({'Content-Type': 'application/x-www-form-urlencoded'})
-    req = requests.post(url, data=data, headers=headers_ex, cookies=cookies)
-    data = json.loads(req.text)
-    if data['code'] != 0:
-        raise RuntimeError(data['message'])
+    })
     return data.get('rtmp')
 
 def stop_live(roomid):
     assert roomid != 0 and len(cookies) != 0
-    url = 'https://api.live.bilibili.com/room/v1/Room/stopLive'
-    data = {
+    api.post('https://api.live.bilibili.com/room/v1/Room/stopLive', {
         'room_id': str(roomid),
-        'csrf': cookies['bili_jct'],
-    }
-    data = urllib.parse.urlencode(data)
-    headers_ex = dict(headers)
-    headers_ex.update({'Content-Type': 'application/x-www-form-urlencoded'})
-    req = requests.post(url, data=data, headers=headers_ex, cookies=cookies)
-    data = json.loads(req.text)
-    if data['code'] != 0:
-        raise RuntimeError(data['message'])
+    })
+
+class OptionsWriter:
+    '''把 options 写回文件
+
+    mark_dirty() 只记录改动，最后一次改动 delay 秒后由后台线程一次性写入，
+    拖动数值框时不会在 GUI 线程里反复写盘。先写临时文件再重命名，写到一半崩溃也不会损坏文件
+    '''
+    def __init__(self, path, delay=1.0):
+        self.path = path
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.dirty = set()
+        self.deadline = 0.0
+        self.thread = None
+
+    def mark_dirty(self, key):
+        with self.lock:
+            self.dirty.add(key)
+            self.deadline = time.monotonic() + self.delay
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.worker, daemon=True)
+                self.thread.start()
+
+    def worker(self):
+        while True:
+            with self.lock:
+                delay = self.deadline - time.monotonic()
+                if delay <= 0:
+                    self.thread = None
+                    break
+            time.sleep(delay)
+        self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                self.dirty.clear()
+                data = json.dumps(dict(options)).encode()
+            atomic_write(self.path, data)
+
+options_writer = OptionsWriter('.bilibili-options.json')
+atexit.register(options_writer.flush)
 
 def set_option(key, value):
     options[key] = value
-    with open('.bilibili-options.json', 'w') as f:
-        json.dump(options, f)
+    options_writer.mark_dirty(key)
+    for listener in option_listeners:
+        listener(key, value)
+
+def on_option_changed(key, value):
+    if key == 'musicRegex':
+        now_playing.set_regex(value)
+    elif key == 'shieldFile':
+        shield_words.set_path(value)
+    elif key in ('metricsEnabled', 'metricsPort'):
+        apply_metrics_options()
+
+option_listeners = [on_option_changed]
 
 class AreaChoiceWindow(QWidget):
     def __init__(self, master, parent=None):
@@ -434,6 +744,7 @@ class AreaChoiceWindow(QWidget):
         self.sub_areas = []
         self.area = 0
         self.title = ''
+        self.loading = False
 
         layout = QVBoxLayout()
         self.live_title = QLineEdit()
@@ -490,35 +801,57 @@ class AreaChoiceWindow(QWidget):
             self.area = 0
 
     def start_live(self):
-        if self.title == '' or not self.areas:
-            info = get_live_info(get_roomid())
-            self.title = info['title']
-            self.live_title.setText(self.title)
-            self.areas = list_live_areas()
-            self.parent_area.addItems(['请选择'] + [a['name'] for a in self.areas])
-            if info['parent_area_id']:
-                self.parent_area.setCurrentText(info['parent_area_name'])
-            if info['area_id']:
-                self.sub_area.setCurrentText(info['area_name'])
+        if (self.title == '' or not self.areas) and not self.loading:
+            self.loading = True
+            self.confirm.setEnabled(False)
+            tasks.submit(lambda: (get_live_info(get_roomid()), list_live_areas()),
+                         on_result=self.on_live_info, on_error=self.on_error)
         self.show()
 
+    def on_live_info(self, result):
+        info, areas = result
+        self.loading = False
+        self.confirm.setEnabled(True)
+        self.title = info['title']
+        self.live_title.setText(self.title)
+        self.areas = areas
+        self.parent_area.addItems(['请选择'] + [a['name'] for a in self.areas])
+        if info['parent_area_id']:
+            self.parent_area.setCurrentText(info['parent_area_name'])
+        if info['area_id']:
+            self.sub_area.setCurrentText(info['area_name'])
+
+    def on_error(self, error):
+        self.loading = False
+        self.confirm.setEnabled(True)
+        self.master.tray_icon.showMessage('弹幕助手', f'操作失败：{error}', self.master.icon, 2000)
+
     def stop_live(self):
-        stop_live(get_roomid())
-        self.master.tray_icon.showMessage('弹幕助手', '已停止直播', self.master.icon, 1000)
+        tasks.submit(lambda: stop_live(get_roomid()),
+                     on_result=lambda _: self.master.tray_icon.showMessage('弹幕助手', '已停止直播', self.master.icon, 1000),
+                     on_error=self.on_error)
 
     def on_confirm(self):
         if self.area != 0:
             print(self.title, self.area)
-            roomid = get_roomid()
-            set_live_title(roomid, self.title)
-            start_live(roomid, self.area)
-            if self.auto_start_obs.checked():
-                try:
-                    subprocess.check_call(['obs', '--startstreaming'])
-                except:
-                    traceback.print_exc()
-            self.master.tray_icon.showMessage('弹幕助手', '已开始直播', self.master.icon, 1000)
-            self.hide()
+            self.confirm.setEnabled(False)
+            tasks.submit(self.do_start_live, self.title, self.area, self.auto_start_obs.isChecked(),
+                         on_result=self.on_started, on_error=self.on_error)
+
+    def do_start_live(self, title, area, auto_start_obs):
+        roomid = get_roomid()
+        set_live_title(roomid, title)
+        start_live(roomid, area)
+        if auto_start_obs:
+            try:
+                subprocess.Popen(['obs', '--startstreaming'])
+            except:
+                traceback.print_exc()
+
+    def on_started(self, _):
+        self.confirm.setEnabled(True)
+        self.master.tray_icon.showMessage('弹幕助手', '已开始直播', self.master.icon, 1000)
+        self.hide()
 
 class SettingsWindow(QWidget):
     def __init__(self, master, parent=None):
@@ -530,7 +863,6 @@ class SettingsWindow(QWidget):
         self.resize(400, 400)
 
         self.login_window = LoginWindow()
-        self.area_choice_window = AreaChoiceWindow(self.master)
 
         layout = QVBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
@@ -553,10 +885,10 @@ class SettingsWindow(QWidget):
         layout.addLayout(hlayout)
         hlayout = QHBoxLayout()
         button = QPushButton('开始直播')
-        button.clicked.connect(self.area_choice_window.start_live)
+        button.clicked.connect(lambda: self.master.get_area_choice_window().start_live())
         hlayout.addWidget(button)
         button = QPushButton('停止直播')
-        button.clicked.connect(self.area_choice_window.stop_live)
+        button.clicked.connect(lambda: self.master.get_area_choice_window().stop_live())
         hlayout.addWidget(button)
         layout.addLayout(hlayout)
         hlayout = QHBoxLayout()
@@ -573,17 +905,49 @@ class SettingsWindow(QWidget):
         hlayout.addWidget(w)
         layout.addLayout(hlayout)
         hlayout = QHBoxLayout()
-        hlayout.addWidget(QLabel('弹幕轮询间隔(秒)'))
+        hlayout.addWidget(QLabel('弹幕轮询间隔(最短~最长秒)'))
         w = QSpinBox()
         w.setRange(1, 60)
-        w.setValue(options['pollInterval'])
-        w.valueChanged.connect(lambda value: set_option('refreshInterval', value))
+        w.setValue(options['minPollInterval'])
+        w.valueChanged.connect(lambda value: set_option('minPollInterval', value))
         hlayout.addWidget(w)
-        hlayout.addWidget(QLabel('刷新间隔(秒)'))
         w = QSpinBox()
         w.setRange(1, 60)
-        w.setValue(options['refreshInterval'])
-        w.valueChanged.connect(lambda value: set_option('refreshInterval', value))
+        w.setValue(options['maxPollInterval'])
+        w.valueChanged.connect(lambda value: set_option('maxPollInterval', value))
+        hlayout.addWidget(w)
+        layout.addLayout(hlayout)
+        hlayout = QHBoxLayout()
+        hlayout.addWidget(QLabel('弹幕获取方式'))
+        w = QComboBox()
+        w.addItems(['轮询', '长连接'])
+        w.setCurrentText(options['fetchMode'])
+        w.currentTextChanged.connect(lambda value: set_option('fetchMode', value))
+        hlayout.addWidget(w)
+        hlayout.addWidget(QLabel('渲染方式'))
+        w = QComboBox()
+        w.addItems(['网页', '原生'])
+        w.setCurrentText(options['renderer'])
+        w.currentTextChanged.connect(lambda value: set_option('renderer', value))
+        hlayout.addWidget(w)
+        layout.addLayout(hlayout)
+        hlayout = QHBoxLayout()
+        w = QCheckBox('打开其他直播间')
+        w.setChecked(options['customRoom'])
+        w.stateChanged.connect(lambda value: set_option('customRoom', bool(value)))
+        hlayout.addWidget(w)
+        w = QSpinBox()
+        w.setRange(1, 2147483647)
+        w.setValue(options['customRoomId'])
+        w.valueChanged.connect(lambda value: set_option('customRoomId', value))
+        hlayout.addWidget(w)
+        layout.addLayout(hlayout)
+        hlayout = QHBoxLayout()
+        hlayout.addWidget(QLabel('同时关注的直播间'))
+        w = QLineEdit()
+        w.setText(options['extraRooms'])
+        w.setPlaceholderText('多个直播间号用逗号分隔')
+        w.textChanged.connect(lambda value: set_option('extraRooms', value))
         hlayout.addWidget(w)
         layout.addLayout(hlayout)
         hlayout = QHBoxLayout()
@@ -661,6 +1025,10 @@ class SettingsWindow(QWidget):
         w.setChecked(options['showMsgTime'])
         w.stateChanged.connect(lambda value: set_option('showMsgTime', value))
         hlayout.addWidget(w)
+        w = QCheckBox('显示头像和表情')
+        w.setChecked(options['showImages'])
+        w.stateChanged.connect(lambda value: set_option('showImages', bool(value)))
+        hlayout.addWidget(w)
         layout.addLayout(hlayout)
         hlayout = QHBoxLayout()
         w = QCheckBox('识别音乐窗口标题')
@@ -674,6 +1042,14 @@ class SettingsWindow(QWidget):
         hlayout.addWidget(w)
         layout.addLayout(hlayout)
         hlayout = QHBoxLayout()
+        hlayout.addWidget(QLabel('屏蔽词文件'))
+        w = QLineEdit()
+        w.setText(options['shieldFile'])
+        w.setPlaceholderText('每行一个正则，留空则不检查')
+        w.textChanged.connect(lambda value: set_option('shieldFile', value))
+        hlayout.addWidget(w)
+        layout.addLayout(hlayout)
+        hlayout = QHBoxLayout()
         hlayout.addWidget(QLabel('弹幕输出文件(可供OBS使用)'))
         w = QLineEdit()
         w.setText(options['danmuFile'])
@@ -692,6 +1068,29 @@ class SettingsWindow(QWidget):
         hlayout.addWidget(w)
         layout.addLayout(hlayout)
         hlayout = QHBoxLayout()
+        w = QCheckBox('统计运行指标')
+        w.setChecked(options['metricsEnabled'])
+        w.stateChanged.connect(lambda value: set_option('metricsEnabled', bool(value)) or self.update_metrics())
+        hlayout.addWidget(w)
+        hlayout.addWidget(QLabel('Prometheus 端口'))
+        w = QSpinBox()
+        w.setRange(0, 65535)
+        w.setSpecialValueText('不开启')
+        w.setValue(options['metricsPort'])
+        # 输入完才应用，否则输入 19100 的过程中会依次去监听 1、19、191、1910 端口
+        w.editingFinished.connect(lambda w=w: set_option('metricsPort', w.value()))
+        hlayout.addWidget(w)
+        layout.addLayout(hlayout)
+        self.metrics_panel = QPlainTextEdit()
+        self.metrics_panel.setReadOnly(True)
+        self.metrics_panel.setFixedHeight(120)
+        self.metrics_panel.setLineWrapMode(QPlainTextEdit.NoWrap)
+        layout.addWidget(self.metrics_panel)
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.update_metrics)
+        self.metrics_timer.start(1000)
+        self.update_metrics()
+        hlayout = QHBoxLayout()
         button = QPushButton('恢复出厂设置')
         button.clicked.connect(lambda: set_option('version', 'restore') or self.restart())
         hlayout.addWidget(button)
@@ -724,7 +1123,13 @@ class SettingsWindow(QWidget):
             button.setStyleSheet(f'padding: 0px; color: grey; background-color: rgb({options[f"{which}R"]}, {options[f"{which}G"]}, {options[f"{which}B"]});')
         return wrapped
 
+    def update_metrics(self):
+        self.metrics_panel.setVisible(metrics.enabled)
+        if metrics.enabled and self.isVisible():
+            self.metrics_panel.setPlainText(metrics.summary())
+
     def restart(self):
+        options_writer.flush()
         os.execl(sys.executable, sys.executable, *sys.argv)
 
     def toggle_window(self):
@@ -735,7 +1140,209 @@ class SettingsWindow(QWidget):
             self.show()
             return False
 
+def message_images(messages):
+    '弹幕中出现的头像和表情 URL'
+    return {url for m in messages for url in m[3:5] if url}
+
+class WebDanmuView(QWidget):
+    '''用 QtWebEngine 显示弹幕，页面只加载一次，之后通过 runJavaScript 增量更新
+
+    图片由 ImageCache 下载到磁盘，网页直接引用本地文件，没下载完之前显示灰色占位
+    '''
+    loaded = Signal()
+
+    def __init__(self, messages, images, parent=None):
+        super().__init__(parent)
+        from PySide2.QtWebEngineWidgets import QWebEngineView, QWebEnginePage, QWebEngineSettings
+
+        self.webView = QWebEngineView()
+        self.webPage = QWebEnginePage()
+        self.webPage.settings().setDefaultTextEncoding('utf-8')
+        self.webPage.settings().setFontSize(QWebEngineSettings.DefaultFontSize, options['fontSize'])
+        self.webPage.settings().setAttribute(QWebEngineSettings.ShowScrollBars, False)
+        self.webPage.setBackgroundColor(Qt.transparent)
+        self.shown_messages = messages
+        self.images = images
+        self.images.ready.connect(self.on_image_ready)
+        self.ready = False
+        self.webPage.loadFinished.connect(self.on_page_loaded)
+        # 以图片缓存目录为 baseUrl，页面才能加载其中的本地文件
+        self.webPage.setHtml(messages_to_html(messages), QUrl.fromLocalFile(os.path.abspath(options['imageCacheDir']) + '/'))
+        self.webView.setPage(self.webPage)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.webView)
+        self.setLayout(layout)
+
+    def on_page_loaded(self, ok):
+        if ok and not self.ready:
+            startup_phase('页面加载完成')
+            self.set_images(message_images(self.shown_messages))
+        self.ready = ok
+        if ok:
+            self.loaded.emit()
+
+    def set_images(self, urls):
+        images = {}
+        for url in urls:
+            file_url = self.images.file_url(url)
+            if file_url is not None:
+                images[url] = file_url
+        if images:
+            self.webPage.runJavaScript(f'setImages({json.dumps(images)})')
+
+    def on_image_ready(self, url):
+        if url in message_images(self.shown_messages):
+            self.set_images([url])
+
+    def apply_style(self):
+        self.webPage.runJavaScript(f'setStyle({json.dumps(style_vars())})')
+
+    def set_messages(self, messages):
+        remove_head, remove_tail, append = diff_messages(self.shown_messages, messages)
+        self.shown_messages = messages
+        images = {}
+        for url in message_images(append):
+            file_url = self.images.file_url(url)
+            if file_url is not None:
+                images[url] = file_url
+        self.webPage.runJavaScript(f'patchMessages({remove_head}, {remove_tail}, {json.dumps(append)}, {json.dumps(images)})')
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+class NativeDanmuView(QWidget):
+    '''不依赖 QtWebEngine 的弹幕视图，用 QPainter 直接绘制
+
+    和 messages_to_html 的效果一致：圆角背景、用户名和弹幕分色、自动换行、始终显示最新的弹幕。
+    每条弹幕的排版结果按窗口宽度缓存，新弹幕到来时只需排版新增的那几条。
+    头像画在左侧，表情画在用户名下方，图片从 ImageCache 取，没下载完时画灰色占位
+    '''
+    loaded = Signal()  # 和 WebDanmuView 接口一致，创建后即可使用，不会发出
+
+    def __init__(self, messages, images, parent=None):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_TranslucentBackground, True)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents, options['bypassWindowManager'])
+        self.ready = True
+        self.messages = messages
+        self.images = images
+        self.images.ready.connect(lambda url: self.update())
+        self.layouts = {}
+        self.layout_width = None
+        self.apply_style()
+
+    def apply_style(self):
+        self.text_font = QFont(options['fontFamily'])
+        self.text_font.setPixelSize(options['fontSize'])
+        alpha = int(options['foregroundOpacity'] * 255)
+        self.username_color = QColor(options['usernameR'], options['usernameG'], options['usernameB'], alpha)
+        self.message_color = QColor(options['messageR'], options['messageG'], options['messageB'], alpha)
+        self.background_color = QColor(options['backgroundR'], options['backgroundG'], options['backgroundB'],
+                                       int(options['backgroundOpacity'] * 255))
+        self.placeholder_color = QColor(128, 128, 128, int(0.3 * alpha))
+        self.layouts.clear()
+        self.update()
+
+    def set_messages(self, messages):
+        self.messages = messages
+        shown = set(messages)
+        self.layouts = {m: l for m, l in self.layouts.items() if m in shown}
+        self.update()
+
+    def make_layout(self, message, width):
+        username, text, *extra = message
+        cssclass, face, emoticon = (list(extra) + ['', '', ''])[:3]
+        size = options['fontSize']
+        indent = size + 4 if face else 0
+        username += ' :'
+        if emoticon:
+            # 表情弹幕的文字是表情名，用图片代替
+            text = ''
+        layout = QTextLayout(username + text, self.text_font)
+        user_format = QTextCharFormat()
+        user_format.setForeground(self.username_color)
+        message_format = QTextCharFormat()
+        message_format.setForeground(self.message_color)
+        message_format.setFontStrikeOut(cssclass == 'shielded')
+        formats = []
+        for start, length, char_format in [(0, utf16_len(username), user_format),
+                                           (utf16_len(username), utf16_len(text), message_format)]:
+            r = QTextLayout.FormatRange()
+            r.start = start
+            r.length = length
+            r.format = char_format
+            formats.append(r)
+        layout.setFormats(formats)
+        text_option = QTextOption()
+        text_option.setWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
+        layout.setTextOption(text_option)
+        height = 0.0
+        layout.beginLayout()
+        while True:
+            line = layout.createLine()
+            if not line.isValid():
+                break
+            line.setLineWidth(width - indent)
+            line.setPosition(QPointF(indent, height))
+            height += line.height()
+        layout.endLayout()
+        face_rect = emoticon_rect = None
+        if face:
+            first_line = layout.lineAt(0).height() if layout.lineCount() else size
+            face_rect = QRectF(0, (first_line - size) / 2, size, size)
+        if emoticon:
+            emoticon_rect = QRectF(indent, height, size * 3, size * 3)
+            height += size * 3
+        return layout, height, (face, face_rect), (emoticon, emoticon_rect)
+
+    def draw_image(self, painter, url, rect, round):
+        pixmap = self.images.pixmap(url)
+        painter.save()
+        path = QPainterPath()
+        if round:
+            path.addEllipse(rect)
+        else:
+            path.addRoundedRect(rect, 4, 4)
+        painter.setClipPath(path)
+        if pixmap is None:
+            painter.fillPath(path, self.placeholder_color)
+        else:
+            painter.setOpacity(options['foregroundOpacity'])
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            painter.drawPixmap(rect.toRect(), pixmap)
+        painter.restore()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(self.background_color)
+        painter.drawRoundedRect(self.rect(), 10, 10)
+        width = self.width()
+        if width != self.layout_width:
+            self.layouts.clear()
+            self.layout_width = width
+        # 从底部往上画，和网页版 scrollIntoView 的效果一样
+        y = self.height()
+        for message in reversed(self.messages):
+            if message not in self.layouts:
+                self.layouts[message] = self.make_layout(message, width)
+            layout, height, (face, face_rect), (emoticon, emoticon_rect) = self.layouts[message]
+            y -= height
+            layout.draw(painter, QPointF(0, y))
+            if face:
+                self.draw_image(painter, face, face_rect.translated(0, y), True)
+            if emoticon:
+                self.draw_image(painter, emoticon, emoticon_rect.translated(0, y), False)
+            if y <= 0:
+                break
+
 class MainWindow(QWidget):
+    messages_ready = Signal()
+    option_changed = Signal(str, object)
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
@@ -754,9 +1361,8 @@ class MainWindow(QWidget):
             self.setAttribute(Qt.WA_TransparentForMouseEvents, True)
         self.setWindowFlags(windowFlags)
 
-        self.settings_window = SettingsWindow(self)
-        if not options['startMinimized']:
-            self.settings_window.show()
+        self.settings_window = None
+        self.area_choice_window = None
 
         self.tray_icon = QSystemTrayIcon(self)
         self.tray_icon.setIcon(self.icon)
@@ -766,16 +1372,16 @@ class MainWindow(QWidget):
         action = tray_menu.addAction("显示/隐藏")
         action.triggered.connect(self.toggle_window)
         action = tray_menu.addAction("开始直播")
-        action.triggered.connect(self.settings_window.area_choice_window.start_live)
+        action.triggered.connect(lambda: self.get_area_choice_window().start_live())
         action = tray_menu.addAction("停止直播")
-        action.triggered.connect(self.settings_window.area_choice_window.stop_live)
+        action.triggered.connect(lambda: self.get_area_choice_window().stop_live())
         action = tray_menu.addAction("设置")
-        action.triggered.connect(self.settings_window.toggle_window)
+        action.triggered.connect(lambda: self.get_settings_window().toggle_window())
         action = tray_menu.addAction("退出")
         action.triggered.connect(QApplication.quit)
 
         self.tray_icon.setContextMenu(tray_menu)
-        self.tray_icon.activated.connect(self.settings_window.toggle_window)
+        self.tray_icon.activated.connect(lambda: self.get_settings_window().toggle_window())
         self.tray_icon.show()
 
         if options['startMinimized']:
@@ -803,39 +1409,121 @@ class MainWindow(QWidget):
             center = desktop.geometry().center()
             self.move(center - QPoint(w // 2, h // 2))
 
-        self.webView = QWebEngineView()
-        self.webPage = QWebEnginePage()
-        self.webPage.settings().setDefaultTextEncoding('utf-8')
-        self.webPage.settings().setFontSize(QWebEngineSettings.DefaultFontSize, options['fontSize'])
-        self.webPage.settings().setAttribute(QWebEngineSettings.ShowScrollBars, False)
-        self.webPage.setBackgroundColor(Qt.transparent)
-        self.webPage.setHtml(messages_to_html([('提示', '请稍等')]))
-        self.webView.setPage(self.webPage)
+        self.placeholder_messages = [('提示', '请稍等')]
+        self.image_cache = ImageCache(fetch_image, options['imageCacheDir'],
+                                      options['imageMemoryBudget'] << 20, options['imageDiskBudget'] << 20)
+        self.first_render = True
+        self.style_dirty = False
+        if options['renderer'] == '原生':
+            self.danmuView = NativeDanmuView(self.placeholder_messages, self.image_cache)
+        else:
+            self.danmuView = WebDanmuView(self.placeholder_messages, self.image_cache)
+        self.danmuView.loaded.connect(self.schedule_update)
+        # set_option 也会在工作线程中调用（比如 get_roomid），从工作线程发出时信号排队到 GUI 线程再处理
+        self.option_changed.connect(self.on_option_changed)
+        option_listeners.append(self.option_changed.emit)
 
         self.inputBar = QLineEdit()
         self.inputBar.setStyleSheet(f'border-radius: 10px; color: rgba({options["messageR"]}, {options["messageG"]}, {options["messageB"]}, {options["foregroundOpacity"]}); background-color: rgba({options["backgroundR"]}, {options["backgroundG"]}, {options["backgroundB"]}, {options["backgroundOpacity"]});')
         self.inputBar.installEventFilter(self)
+        self.danmu_sender = DanmuSender(self)
+        self.danmu_sender.status.connect(self.on_send_status)
         if options['bypassWindowManager']:
             self.inputBar.hide()
 
         layout = QVBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
-        layout.addWidget(self.webView)
+        layout.addWidget(self.danmuView)
         layout.addWidget(self.inputBar)
         self.setLayout(layout)
 
-        self.queue = queue.Queue(maxsize=1)
+        self.feeds = None
+        self.file_sink = DanmuFileSink(options['danmuFile'], options['danmuFormat'],
+                                       options['danmuFileLines'], options['danmuFileInterval'])
+        self.history = HistoryStore(options['historyFile']) if options['historyFile'] else None
+        # 工作线程只保留最新的一份弹幕列表，通过 messages_ready 信号通知 GUI 线程，
+        # 两次刷新至少间隔一帧，刷屏时中间的列表直接被覆盖，不会堆积
+        self.pending_messages = None
+        self.pending_lock = threading.Lock()
+        self.update_scheduled = False
+        self.last_render = 0.0
+        refresh_rate = QApplication.primaryScreen().refreshRate() if QApplication.primaryScreen() else 60
+        self.frame_interval = 1 / (refresh_rate if refresh_rate > 0 else 60)
+        self.messages_ready.connect(self.update_messages, Qt.QueuedConnection)
+        metrics.Gauge('danmu_queue_size', '等待显示的弹幕列表数（0 或 1）', func=lambda: int(self.pending_messages is not None))
+
+        # 弹幕窗口隐藏、也没有输出文件和历史记录时，没有人需要弹幕，工作线程停止请求
+        self.demand = threading.Event()
+        self.display_active = False
+        self.wakeup = threading.Event()
+        self.update_demand()
         threading.Thread(target=self.message_worker, daemon=True).start()
 
-        self.update_messages()
-        timer = QTimer(self)
-        timer.timeout.connect(self.update_messages)
-        timer.start(500)
-        timer.setSingleShot(False)
-
     def closeEvent(self, event):
         event.ignore()
 
+    def showEvent(self, event):
+        # 隐藏期间收到的弹幕留在 pending_messages 中，显示出来时再刷新
+        super().showEvent(event)
+        self.update_demand()
+        self.schedule_update()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.update_demand()
+
+    def update_demand(self):
+        '''根据弹幕的使用者（窗口、OBS 文件、历史记录）决定工作线程是否继续获取弹幕
+
+        历史记录默认开启，只有设置了 historyWhenHidden 才会在窗口隐藏时继续获取弹幕来保存
+        '''
+        self.display_active = self.isVisible() or bool(options['danmuFile'])
+        now_playing.set_active(self.display_active and options['showMusicName'])
+        if self.display_active or (self.history is not None and options['historyWhenHidden']):
+            if not self.demand.is_set():
+                self.demand.set()
+                self.wakeup.set()
+        elif self.demand.is_set():
+            self.demand.clear()
+            self.wakeup.set()
+
+    def get_settings_window(self):
+        if self.settings_window is None:
+            self.settings_window = SettingsWindow(self)
+        return self.settings_window
+
+    def get_area_choice_window(self):
+        if self.area_choice_window is None:
+            self.area_choice_window = AreaChoiceWindow(self)
+        return self.area_choice_window
+
+    def on_option_changed(self, key, value):
+        # 通过 option_changed 信号调用，总是在 GUI 线程中，可以直接替换 file_sink、history 等
+        if key in style_keys:
+            self.style_dirty = True
+            self.schedule_update()
+        elif key == 'minPollInterval':
+            for feed in self.feeds or []:
+                feed.scheduler.min_interval = value
+        elif key == 'maxPollInterval':
+            for feed in self.feeds or []:
+                feed.scheduler.max_interval = value
+        elif key == 'danmuFile':
+            self.file_sink.set_path(value)
+            self.update_demand()
+        elif key == 'showMusicName':
+            self.update_demand()
+        elif key == 'historyFile':
+            # 先换上新的再关闭旧的，旧文件里不会丢掉还没写入的弹幕
+            old, self.history = self.history, HistoryStore(value) if value else None
+            if old is not None:
+                old.close()
+            self.update_demand()
+        elif key == 'historyWhenHidden':
+            self.update_demand()
+        elif key == 'danmuFormat':
+            self.file_sink.set_format(value)
+
     def eventFilter(self, target, event):
         if target == self.inputBar:
             if event.type() == QEvent.KeyPress:
@@ -847,9 +1535,23 @@ class MainWindow(QWidget):
     def on_send(self):
         msg = self.inputBar.text().strip()
         if msg:
-            send_message(get_roomid(), msg)
+            self.danmu_sender.send(self.feeds[0].roomid if self.feeds else None, msg)
             self.inputBar.setText('')
 
+    def on_send_status(self, text, status, message):
+        if status == 'sending':
+            self.inputBar.setPlaceholderText(f'正在发送：{text}')
+        elif status == 'retrying':
+            self.inputBar.setPlaceholderText(f'发送过快，稍后重试：{text}')
+        elif status == 'sent':
+            self.inputBar.setPlaceholderText('')
+        elif status == 'failed':
+            self.inputBar.setPlaceholderText('')
+            if not self.inputBar.text():
+                # 发送失败时把弹幕放回输入框，方便修改后重发
+                self.inputBar.setText(text)
+            self.tray_icon.showMessage('弹幕发送失败', message, self.icon, 2000)
+
     def toggle_window(self):
         if self.isVisible():
             self.hide()
@@ -870,64 +1572,160 @@ class MainWindow(QWidget):
     #         print('out')
     #         self.setAttribute(Qt.WA_TransparentForMouseEvents, True)
 
+    def pause_feeds(self):
+        '没有使用者时断开长连接，恢复时重新连接并补拉一次历史弹幕'
+        for feed in self.feeds or []:
+            if feed.client is not None:
+                feed.client.stop()
+                feed.client = None
+
+    def resume_feeds(self):
+        for feed in self.feeds or []:
+            # 立即补拉一次；暂停期间的间隔不计入弹幕速率
+            feed.next_poll = 0.0
+            feed.scheduler.last_poll = None
+
     def message_worker(self):
-        roomid = None
-        old_messages = []
-        countdown = options['refreshCountdown']
+        def on_danmu(feed, m):
+            messages_received.inc(source='push')
+            self.on_new_messages(feed.roomid, feed.store.add([DanmuMessage.from_history(m)]))
+            self.wakeup.set()
+
+        old_state = None
         while True:
-            if self.queue.full():
-                time.sleep(1)
-                continue
+            if not self.demand.is_set():
+                self.pause_feeds()
+                self.demand.wait()
+                self.resume_feeds()
+            hints = []
             try:
-                if roomid is None:
-                    roomid = get_roomid()
-                messages = get_messages(roomid)
+                if self.feeds is None:
+                    self.feeds = [RoomFeed(roomid) for roomid in get_watch_roomids()]
+                    startup_phase('获取直播间号')
             except:
                 traceback.print_exc()
+                time.sleep(options['maxPollInterval'])
                 continue
-            if len(messages) == 0:
-                messages.append(('提示', '还没有弹幕，快来发一条吧'))
-            if options['showMusicName']:
+            if len(cookies) == 0:
+                hints = [('提示', '未登录，请先点击托盘图标，在设置中扫码登录您的B站账号')]
+            elif len(self.feeds) == 0:
+                hints = [('提示', '直播间不存在')]
+            # 所有直播间共用这一个线程和 api 的连接池，每多一个直播间只多一次请求（或一条长连接）
+            now = time.monotonic()
+            for feed in self.feeds if not hints else []:
+                try:
+                    if options['fetchMode'] == '长连接':
+                        if feed.client is None:
+                            # 先用历史弹幕填充，之后的弹幕由长连接推送
+                            self.on_new_messages(feed.roomid, feed.store.add(get_messages(feed.roomid)))
+                            feed.client = DanmuClient(feed.roomid, lambda m, feed=feed: on_danmu(feed, m), get_danmu_info,
+                                                      uid=get_my_uid(), buvid=cookies.get('buvid3', ''))
+                            feed.client.start()
+                    elif now >= feed.next_poll:
+                        new = feed.store.add(get_messages(feed.roomid))
+                        self.on_new_messages(feed.roomid, new)
+                        feed.next_poll = now + feed.scheduler.update(len(new))
+                except:
+                    traceback.print_exc()
+                    feed.next_poll = now + feed.scheduler.max_interval
+            music = ''
+            if options['showMusicName'] and self.display_active:
                 music = current_music().strip()
+            feeds = self.feeds if not hints else []
+            state = (tuple(feed.store.version for feed in feeds), options['showUserMedal'], options['showMsgTime'],
+                     options['showImages'], hints, music)
+            if state != old_state:
+                if hints:
+                    messages = list(hints)
+                else:
+                    messages = []
+                    for user, text, m in merge_feeds(feeds, 10, options['showUserMedal'], options['showMsgTime']):
+                        # (用户名, 弹幕, 样式, 头像, 表情)，命中屏蔽词的弹幕在本地标记出来，末尾为空的字段省略
+                        item = (user, text, 'shielded' if shield_words.search(text) else '')
+                        if options['showImages']:
+                            item += (m.face, m.emoticon)
+                        while len(item) > 2 and not item[-1]:
+                            item = item[:-1]
+                        messages.append(item)
+                if len(messages) == 0:
+                    messages.append(('提示', '还没有弹幕，快来发一条吧'))
                 if music:
                     messages.append(('当前播放', music))
-            if messages != old_messages:
                 if options['danmuFile']:
-                    with open(options['danmuFile'], 'w') as f:
-                        danmuFormat = options['danmuFormat']
-                        danmuText = '\n'.join(u + ' :' + m for u, m in messages)
-                        if danmuFormat:
-                            danmuText = danmuFormat.format(danmu=danmuText)
-                        f.write(danmuText)
-                content = messages_to_html(messages)
-                try:
-                    self.queue.put(content, block=False)
-                except queue.Full:
-                    pass
-                old_messages = messages
-                countdown = options['refreshCountdown']
-            if countdown > 0:
-                # print('refresh')
-                time.sleep(options['refreshInterval'])
-                countdown = countdown - 1
-            else:
-                # print('poll')
-                time.sleep(options['pollInterval'])
+                    self.file_sink.update(messages)
+                self.post_messages(messages)
+                old_state = state
+            # 长连接模式下有新弹幕立即刷新，否则等到下一个直播间该轮询的时候
+            timeout = options['maxPollInterval']
+            if options['fetchMode'] != '长连接' and feeds:
+                timeout = max(min(feed.next_poll for feed in feeds) - time.monotonic(), 0)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def on_new_messages(self, roomid, messages):
+        messages_new.inc(len(messages))
+        if self.history is not None and messages:
+            self.history.add(roomid, messages)
+
+    def post_messages(self, messages):
+        '在工作线程中调用，交给 GUI 线程显示'
+        with self.pending_lock:
+            if self.pending_messages is not None:
+                updates_dropped.inc()
+            self.pending_messages = messages
+        self.schedule_update()
+
+    def schedule_update(self):
+        with self.pending_lock:
+            if self.update_scheduled:
+                return
+            self.update_scheduled = True
+        self.messages_ready.emit()
 
     def update_messages(self):
-        if self.isHidden():
+        wait = self.last_render + self.frame_interval - time.monotonic()
+        if wait > 0:
+            QTimer.singleShot(int(wait * 1000) + 1, self.update_messages)
             return
-        try:
-            content = self.queue.get(block=False)
-        except queue.Empty:
+        with self.pending_lock:
+            self.update_scheduled = False
+            if self.isHidden() or not self.danmuView.ready:
+                return
+            messages, self.pending_messages = self.pending_messages, None
+        if self.style_dirty:
+            self.style_dirty = False
+            self.danmuView.apply_style()
+        if messages is None:
             return
-        self.webPage.setHtml(content)
+        self.last_render = time.monotonic()
+        if self.first_render:
+            self.first_render = False
+            startup_phase('首次显示弹幕')
+        started = time.perf_counter()
+        self.danmuView.set_messages(messages)
+        render_seconds.observe(time.perf_counter() - started)
 
 
 def main():
+    global tasks
+    # 允许在 QApplication 创建之后再导入 QtWebEngineWidgets
+    QApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
+    tasks = TaskRunner(app)
+    app.aboutToQuit.connect(options_writer.flush)
+    startup_phase('创建 QApplication')
     win = MainWindow()
+    app.aboutToQuit.connect(lambda: win.history is not None and win.history.close())
+    startup_phase('创建弹幕窗口')
     win.show()
+    startup_phase('显示弹幕窗口')
+    if not options['startMinimized']:
+        # 等弹幕窗口显示出来以后再创建设置窗口
+        def show_settings():
+            win.get_settings_window().show()
+            startup_phase('显示设置窗口')
+        QTimer.singleShot(0, show_settings)
+    QTimer.singleShot(0, lambda: startup_phase('进入事件循环'))
     return app.exec_()
 
 
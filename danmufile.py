@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import traceback
+import threading
+import tempfile
+import string
+import time
+import os
+
+import metrics
+
+file_writes = metrics.Counter('danmu_file_writes_total', '弹幕文件写入次数', ['result'])
+file_write_seconds = metrics.Histogram('danmu_file_write_seconds', '弹幕文件写入耗时')
+
+def format_or_plain(fmt, danmu):
+    try:
+        return fmt.format(danmu=danmu)
+    except (KeyError, IndexError, ValueError, AttributeError, TypeError):
+        # 设置界面中正在输入的 {}、{foo}、{danmu.x} 等字段，先只输出弹幕
+        return danmu
+
+def compile_format(fmt):
+    '''预先解析 danmuFormat，返回 render(danmu) 函数
+
+    只含 {danmu} 字段的格式直接拼接字符串，其他情况退回 str.format
+    '''
+    if not fmt:
+        return lambda danmu: danmu
+    parts = []
+    try:
+        for literal, field, spec, conversion in string.Formatter().parse(fmt):
+            parts.append(literal)
+            if field is None:
+                continue
+            if field != 'danmu' or spec or conversion:
+                return lambda danmu: format_or_plain(fmt, danmu)
+            parts.append(None)
+    except ValueError:
+        # 设置界面中正在编辑的格式可能还不完整，先只输出弹幕
+        return lambda danmu: danmu
+    return lambda danmu: ''.join(danmu if p is None else p for p in parts)
+
+# mkstemp 创建的文件权限是 0600，替换后要和普通 open() 创建的文件一样；umask 只能读取后再设回去，所以在导入时读一次
+umask = os.umask(0)
+os.umask(umask)
+
+def atomic_write(path, data: bytes):
+    '写入临时文件后再重命名，OBS 不会读到写了一半的文件'
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.danmu-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            # 先落盘再重命名，断电后不会留下一个空文件
+            os.fsync(f.fileno())
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~umask
+        os.chmod(tmp, mode)
+        try:
+            os.replace(tmp, path)
+        except PermissionError:
+            # Windows 上目标文件被占用时无法替换，退回直接写入
+            with open(path, 'wb') as f:
+                f.write(data)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+class DanmuFileSink:
+    '''把弹幕写到文件供 OBS 读取
+
+    两次写入至少间隔 min_interval 秒，期间的更新合并成一次；内容没变时不写入
+    '''
+    def __init__(self, path, fmt, max_lines=10, min_interval=0.5):
+        self.path = path
+        self.render = compile_format(fmt)
+        self.max_lines = max_lines
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.pending = None
+        self.timer = None
+        self.last_write = 0.0
+        self.last_data = None
+        self.writes = 0
+
+    def set_path(self, path):
+        with self.lock:
+            self.path = path
+            self.last_data = None
+
+    def set_format(self, fmt):
+        with self.lock:
+            self.render = compile_format(fmt)
+
+    def format(self, messages) -> bytes:
+        if self.max_lines:
+            messages = messages[-self.max_lines:]
+        danmu = '\n'.join(u + ' :' + m for u, m, *_ in messages)
+        return self.render(danmu).encode('utf-8')
+
+    def update(self, messages):
+        with self.lock:
+            self.pending = messages
+            if self.timer is not None:
+                return
+            delay = self.last_write + self.min_interval - time.monotonic()
+            if delay > 0:
+                self.timer = threading.Timer(delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            messages, self.pending = self.pending, None
+            if messages is None or not self.path:
+                return
+            data = self.format(messages)
+            if data == self.last_data:
+                file_writes.inc(result='unchanged')
+                return
+            self.last_write = time.monotonic()
+            try:
+                atomic_write(self.path, data)
+            except OSError:
+                file_writes.inc(result='error')
+                traceback.print_exc()
+                return
+            file_write_seconds.observe(time.monotonic() - self.last_write)
+            file_writes.inc(result='ok')
+            self.last_data = data
+            self.writes += 1
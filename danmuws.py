@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+import threading
+import traceback
+import socket
+import struct
+import random
+import json
+import zlib
+import time
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 包头：总长度、头长度、协议版本、操作码、序号
+HEADER = struct.Struct('>IHHII')
+
+OP_HEARTBEAT = 2
+OP_HEARTBEAT_REPLY = 3
+OP_MESSAGE = 5
+OP_AUTH = 7
+OP_AUTH_REPLY = 8
+
+# 单个包的最大长度，防止错误或恶意的包头导致无限循环或一次分配巨大的内存
+MAX_PACKET = 16 << 20
+
+VER_PLAIN = 0
+VER_INT = 1
+VER_ZLIB = 2
+VER_BROTLI = 3
+
+def make_packet(op, body=b'', ver=VER_INT):
+    if isinstance(body, dict):
+        body = json.dumps(body, separators=(',', ':')).encode()
+    return HEADER.pack(HEADER.size + len(body), HEADER.size, ver, op, 1) + body
+
+def check_header(length, header_len):
+    if not HEADER.size <= header_len <= length <= MAX_PACKET:
+        raise ConnectionError(f'包头错误：长度 {length}，头长度 {header_len}')
+
+def parse_packets(data):
+    '拆分数据包，递归解压 zlib/brotli 压缩的消息包'
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, header_len, ver, op, _ = HEADER.unpack_from(data, offset)
+        check_header(length, header_len)
+        if offset + length > len(data):
+            raise ConnectionError(f'数据包不完整：需要 {length} 字节，只有 {len(data) - offset} 字节')
+        body = data[offset + header_len:offset + length]
+        offset += length
+        if op == OP_MESSAGE and ver == VER_ZLIB:
+            yield from parse_packets(zlib.decompress(body))
+        elif op == OP_MESSAGE and ver == VER_BROTLI:
+            if brotli is None:
+                raise RuntimeError('收到 brotli 压缩包，但没有安装 brotli')
+            yield from parse_packets(brotli.decompress(body))
+        else:
+            yield op, body
+
+def recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('连接已被服务器关闭')
+        buf += chunk
+    return bytes(buf)
+
+def recv_packet(sock):
+    header = recv_exact(sock, HEADER.size)
+    length, header_len, _, _, _ = HEADER.unpack(header)
+    check_header(length, header_len)
+    return header + recv_exact(sock, length - HEADER.size)
+
+def danmu_to_history(info):
+    '把 DANMU_MSG 的 info 字段转换成和 gethistory 相同的格式'
+    timestamp = info[0][4] / 1000
+    check_info = {'ts': int(timestamp), 'ct': ''}
+    if len(info) > 9 and isinstance(info[9], dict):
+        check_info = info[9]
+    extra = info[0][15] if len(info[0]) > 15 and isinstance(info[0][15], dict) else {}
+    emoticon = info[0][13] if len(info[0]) > 13 and isinstance(info[0][13], dict) else {}
+    return {
+        'uid': info[2][0],
+        'nickname': info[2][1],
+        'text': info[1],
+        'medal': info[3],
+        'timeline': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+        'check_info': check_info,
+        'user': extra.get('user') or {},
+        'emoticon': emoticon,
+    }
+
+class DanmuClient(threading.Thread):
+    '''直播间长连接客户端，收到弹幕时调用 on_danmu(message)
+
+    get_auth(roomid) 返回 (host, port, token)，每次重连都会重新获取
+    '''
+    def __init__(self, roomid, on_danmu, get_auth, uid=0, buvid='', heartbeat=30, reconnect=(1, 60)):
+        super().__init__(daemon=True)
+        self.roomid = roomid
+        self.on_danmu = on_danmu
+        self.get_auth = get_auth
+        self.uid = uid
+        self.buvid = buvid
+        self.heartbeat = heartbeat
+        self.reconnect = reconnect
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+        self.sock = None
+
+    def stop(self):
+        self.stopped.set()
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        delay = self.reconnect[0]
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.session()
+            except Exception:
+                if self.stopped.is_set():
+                    break
+                traceback.print_exc()
+            finally:
+                self.connected.clear()
+            if time.monotonic() - started > self.reconnect[1]:
+                delay = self.reconnect[0]
+            # 加一点随机抖动，避免断线后和其他客户端同时重连
+            self.stopped.wait(delay * random.uniform(1, 1.5))
+            delay = min(delay * 2, self.reconnect[1])
+
+    def session(self):
+        host, port, token = self.get_auth(self.roomid)
+        sock = socket.create_connection((host, port), timeout=10)
+        self.sock = sock
+        try:
+            auth = {
+                'uid': self.uid,
+                'roomid': self.roomid,
+                'protover': VER_BROTLI if brotli is not None else VER_ZLIB,
+                'platform': 'web',
+                'type': 2,
+                'key': token,
+            }
+            if self.buvid:
+                auth['buvid'] = self.buvid
+            sock.sendall(make_packet(OP_AUTH, auth))
+            for op, body in parse_packets(recv_packet(sock)):
+                if op != OP_AUTH_REPLY:
+                    raise ConnectionError(f'认证失败：预期操作码 {OP_AUTH_REPLY}，收到 {op}')
+                if json.loads(body).get('code', 0) != 0:
+                    raise ConnectionError(f'认证失败：{body.decode(errors="replace")}')
+            self.connected.set()
+            threading.Thread(target=self.heartbeat_worker, args=[sock], daemon=True).start()
+            # 服务器会回复每个心跳包，超过两个心跳周期没有数据说明连接已断开
+            sock.settimeout(self.heartbeat * 2 + 10)
+            while not self.stopped.is_set():
+                for op, body in parse_packets(recv_packet(sock)):
+                    if op == OP_MESSAGE:
+                        self.dispatch(json.loads(body))
+        finally:
+            self.sock = None
+            sock.close()
+
+    def heartbeat_worker(self, sock):
+        packet = make_packet(OP_HEARTBEAT, b'[object Object]')
+        while self.sock is sock:
+            try:
+                sock.sendall(packet)
+            except OSError:
+                break
+            if self.stopped.wait(self.heartbeat):
+                break
+
+    def dispatch(self, cmd):
+        if cmd.get('cmd', '').split(':')[0] != 'DANMU_MSG':
+            return
+        try:
+            message = danmu_to_history(cmd['info'])
+        except (KeyError, IndexError, TypeError):
+            traceback.print_exc()
+            return
+        self.on_danmu(message)
+
+def fake_server(port=2243, interval=1.0):
+    '本地测试用的长连接服务器，认证后每隔 interval 秒推送 zlib 压缩的弹幕'
+    def handle(conn):
+        with conn:
+            for op, body in parse_packets(recv_packet(conn)):
+                assert op == OP_AUTH, op
+                print('认证：', body.decode())
+            conn.sendall(make_packet(OP_AUTH_REPLY, {'code': 0}))
+            count = 0
+            conn.settimeout(interval)
+            while True:
+                try:
+                    for op, _ in parse_packets(recv_packet(conn)):
+                        if op == OP_HEARTBEAT:
+                            conn.sendall(make_packet(OP_HEARTBEAT_REPLY, struct.pack('>I', 1)))
+                except socket.timeout:
+                    pass
+                except (ConnectionError, OSError):
+                    return
+                # 每次推送两条弹幕，合并在同一个压缩包里
+                inner = b''
+                for _ in range(2):
+                    count += 1
+                    now = int(time.time() * 1000)
+                    cmd = {'cmd': 'DANMU_MSG', 'info': [
+                        [0, 1, 25, 0xffffff, now, 0, 0, ''],
+                        f'测试弹幕 {count}',
+                        [10000 + count % 7, f'用户{count % 7}'],
+                        [count % 30, '测试', '主播', 0, 0, '', 0, 0, 0, 0, 0, 1],
+                        [0, 0, 9868950, '>50000', 0],
+                        ['', ''],
+                        0, 0, None,
+                        {'ts': now // 1000, 'ct': f'{count:08X}'},
+                    ]}
+                    inner += make_packet(OP_MESSAGE, cmd, VER_PLAIN)
+                try:
+                    conn.sendall(make_packet(OP_MESSAGE, zlib.compress(inner), VER_ZLIB))
+                except OSError:
+                    return
+    with socket.create_server(('127.0.0.1', port)) as server:
+        print(f'测试服务器已启动：127.0.0.1:{port}')
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=[conn], daemon=True).start()
+
+if __name__ == '__main__':
+    # python danmuws.py --fake-server 2243
+    # python danmuws.py 75287 127.0.0.1 2243
+    if sys.argv[1] == '--fake-server':
+        fake_server(int(sys.argv[2]) if len(sys.argv) > 2 else 2243)
+    else:
+        roomid, host, port = int(sys.argv[1]), sys.argv[2], int(sys.argv[3])
+        client = DanmuClient(roomid, lambda m: print(m['timeline'], m['nickname'], ':', m['text']),
+                             lambda roomid: (host, port, ''))
+        client.start()
+        client.join()
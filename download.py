@@ -1,15 +1,176 @@
 #!/usr/bin/python
 
+import concurrent.futures
 import subprocess
+import threading
 import os
-import tempfile
 import requests
+import requests.adapters
 import json
+import time
 import sys
 import re
 
-with open(os.path.expanduser('.bilibili-cookies.json'), 'r') as f:
-    cookies = json.load(f)
+from biliapi import api_url
+from danmufile import atomic_write
+
+cookies = {}
+if os.path.exists('.bilibili-cookies.json'):
+    with open('.bilibili-cookies.json', 'r') as f:
+        cookies = json.load(f)
+
+# 分段并行下载的连接数
+workers = 4
+segment_size = 8 << 20
+
+session = requests.Session()
+session.cookies.update(cookies)
+for prefix in ('https://', 'http://'):
+    session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=workers))
+
+
+class Progress:
+    '''按实际写入磁盘的字节数显示下载进度'''
+    def __init__(self, name, total, done=0):
+        self.name = name
+        self.total = total
+        self.written = done
+        self.started = time.monotonic()
+        self.resumed = done
+        self.last_report = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.written += n
+            now = time.monotonic()
+            if now - self.last_report < 0.5:
+                return
+            self.last_report = now
+        self.report()
+
+    def report(self, end=''):
+        elapsed = max(time.monotonic() - self.started, 1e-3)
+        speed = (self.written - self.resumed) / elapsed / 1024 / 1024
+        total = '{:.1f}'.format(self.total / 1024 / 1024) if self.total else '?'
+        print('\r{}：{:.1f}/{} MB  {:.1f} MB/s'.format(self.name, self.written / 1024 / 1024, total, speed),
+              end=end, flush=True)
+
+
+def probe(url, headers):
+    '''用 Range: bytes=0-0 探测文件大小以及服务器是否支持分段下载'''
+    with session.get(url, headers=dict(headers, Range='bytes=0-0'), stream=True, timeout=(10, 30)) as req:
+        req.raise_for_status()
+        validator = req.headers.get('ETag') or req.headers.get('Last-Modified') or ''
+        m = re.match(r'bytes 0-0/(\d+)', req.headers.get('Content-Range', ''))
+        if req.status_code == 206 and m:
+            return int(m.group(1)), True, validator
+        return int(req.headers.get('Content-Length', 0)), False, validator
+
+
+def fetch_range(url, headers, f, byte_range, on_write):
+    '''把 [start, end) 区间边下载边写入 f 的当前位置，byte_range 为 None 时下载整个文件'''
+    if byte_range is not None:
+        headers = dict(headers, Range='bytes={}-{}'.format(byte_range[0], byte_range[1] - 1))
+    with session.get(url, headers=headers, stream=True, timeout=(10, 30)) as req:
+        req.raise_for_status()
+        if byte_range is not None and (req.status_code != 206 or not req.headers.get(
+                'Content-Range', '').startswith('bytes {}-'.format(byte_range[0]))):
+            raise IOError('服务器没有按 Range 返回：{}'.format(req.status_code))
+        for chunk in req.iter_content(256 << 10):
+            f.write(chunk)
+            on_write(len(chunk))
+
+
+def load_journal(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def fetch_file(url, path, headers, name='下载', retries=5):
+    '''流式下载 url 到 path
+
+    内容先写入 path.part，下完再改名。服务器支持 Range 时按 segment_size 切分，用 workers 个连接并行下载；
+    每下完一段记到 path.part.json 里，中断后重新运行会跳过已下完的分段，每段失败时单独重试
+    '''
+    size, ranged, validator = probe(url, headers)
+    print('{}大小：{} MB'.format(name, round(size / 1024 / 1024, 3)))
+    if size and os.path.exists(path) and os.path.getsize(path) == size:
+        # av 模式下视频下完、音频中断时，重新运行不用再下一遍视频
+        print('{}已下载完成，跳过：{}'.format(name, path))
+        return
+    part = path + '.part'
+    journal_path = part + '.json'
+    if not ranged or not size:
+        # 不支持 Range 时只能从头流式下载
+        progress = Progress(name, size)
+        with open(part, 'wb') as f:
+            fetch_range(url, headers, f, None, progress.add)
+        progress.report('\n')
+        os.replace(part, path)
+        return
+
+    journal = load_journal(journal_path)
+    if (journal is None or not os.path.exists(part) or os.path.getsize(part) != size
+            or journal.get('size') != size or journal.get('segment_size') != segment_size
+            or journal.get('validator') != validator):
+        # 没有可以接着下的记录，或者文件已经变了
+        journal = {'size': size, 'segment_size': segment_size, 'validator': validator, 'done': []}
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        atomic_write(journal_path, json.dumps(journal).encode())
+    segments = [(start, min(start + segment_size, size)) for start in range(0, size, segment_size)]
+    done = set(journal['done'])
+    if done:
+        print('继续上次的下载，已完成 {}/{} 段'.format(len(done), len(segments)))
+    progress = Progress(name, size, sum(end - start for i, (start, end) in enumerate(segments) if i in done))
+    lock = threading.Lock()
+
+    def fetch_segment(i):
+        start, end = segments[i]
+        for attempt in range(retries):
+            written = 0
+
+            def on_write(n):
+                nonlocal written
+                written += n
+                progress.add(n)
+            try:
+                with open(part, 'r+b') as f:
+                    f.seek(start)
+                    fetch_range(url, headers, f, (start, end), on_write)
+                    if written != end - start:
+                        raise IOError('分段不完整：{}/{}'.format(written, end - start))
+                    f.flush()
+                    os.fsync(f.fileno())
+                break
+            except (requests.RequestException, IOError) as e:
+                progress.add(-written)
+                if attempt == retries - 1:
+                    raise
+                print('\n分段 {} 下载失败，重试：{}'.format(i, e))
+                time.sleep(2 ** attempt)
+        with lock:
+            journal['done'].append(i)
+            atomic_write(journal_path, json.dumps(journal).encode())
+
+    todo = [i for i in range(len(segments)) if i not in done]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_segment, i) for i in todo]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            # 已下完的分段都记在 .part.json 里了，下次运行接着下
+            for future in futures:
+                future.cancel()
+            raise
+    progress.report('\n')
+    os.replace(part, path)
+    os.unlink(journal_path)
 
 
 def download(url, mode='av', out_file=None, quality=0):
@@ -24,7 +185,7 @@ def download(url, mode='av', out_file=None, quality=0):
         'User-Agent':
         'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.116 Safari/537.36'
     }
-    res_data = requests.get(url, headers=headers, cookies=cookies)
+    res_data = requests.get(api_url(url), headers=headers, cookies=cookies)
     # 获取视频信息
     pattern_video = '__playinfo__=(.*?)</script><script>'
     pattern_title = '<h1 title="(.*?)" class="video-title" data-v-'
@@ -55,41 +216,28 @@ def download(url, mode='av', out_file=None, quality=0):
     vidheaders = dict(**headers)
     vidheaders.update({'Referer': url})
     if mode == 'av':
-        videofile = tempfile.NamedTemporaryFile('wb')
-        audiofile = tempfile.NamedTemporaryFile('wb')
+        # 不用临时文件，下载中断后再运行可以接着下
+        video_file = out_file + '.video.m4s'
+        audio_file = out_file + '.audio.m4s'
     elif mode == 'a':
-        audiofile = open(out_file, 'wb')
+        audio_file = out_file
     elif mode == 'v':
-        videofile = open(out_file, 'wb')
+        video_file = out_file
     if mode in ['v', 'av']:
         print('视频下载开始：{}'.format(video_url))
-        video_content = requests.get(video_url,
-                                     headers=vidheaders,
-                                     cookies=cookies)
-        print('视频大小：{} MB'.format(
-            round(
-                int(video_content.headers.get('content-length', 0)) / 1024 /
-                1024, 3)))
-        videofile.write(video_content.content)
-        print('视频下载结束：{}'.format(videofile.name))
+        fetch_file(video_url, video_file, vidheaders, '视频')
+        print('视频下载结束：{}'.format(video_file))
     if mode in ['a', 'av']:
         print('音频下载开始：{}'.format(audio_url))
-        audio_content = requests.get(audio_url,
-                                     headers=vidheaders,
-                                     cookies=cookies)
-        print('音频大小：{} MB'.format(
-            round(
-                int(audio_content.headers.get('content-length', 0)) / 1024 /
-                1024, 3)))
-        audiofile.write(audio_content.content)
-        print('音频下载结束：{}'.format(audiofile.name))
+        fetch_file(audio_url, audio_file, vidheaders, '音频')
+        print('音频下载结束：{}'.format(audio_file))
     if mode == 'av':
         command = [
             'ffmpeg',
             '-i',
-            videofile.name,
+            video_file,
             '-i',
-            audiofile.name,
+            audio_file,
             '-c',
             'copy',
             out_file,
@@ -98,9 +246,8 @@ def download(url, mode='av', out_file=None, quality=0):
         print('视频合成开始：{}'.format(' '.join(command)))
         subprocess.check_call(command)
         print('视频合成结束：{}'.format(out_file))
-        videofile.close()
-        audiofile.close()
-
+        os.unlink(video_file)
+        os.unlink(audio_file)
 
 if __name__ == '__main__':
     url = sys.argv[1]
@@ -3,6 +3,9 @@
 import requests
 import json
 import sys
+import os
+
+from biliapi import api_url
 
 # with open(os.path.expanduser('~/.bilibili-cookies.json'), 'r') as f:
 #     cookies = {item['name']: item['value'] for item in json.load(f)}
@@ -14,14 +17,17 @@ headers = {
     'Content-Type': 'application/x-www-form-urlencoded',
 }
 
-with open('.bilibili-cookies.json', 'r') as f:
-    cookies = json.load(f)
+if os.path.exists('.bilibili-cookies.json'):
+    with open('.bilibili-cookies.json', 'r') as f:
+        cookies = json.load(f)
+else:
+    cookies = {}
 # with open('.cookies.json', 'r') as f:
 #     cookies = {x['name']: x['value'] for x in json.load(f)}
 
 def get_my_uid():
     url = 'https://api.bilibili.com/x/web-interface/nav'
-    req = requests.get(url, headers=headers, cookies=cookies)
+    req = requests.get(api_url(url), headers=headers, cookies=cookies)
     rep = json.loads(req.text)
     if rep['code'] != 0:
         raise RuntimeError(rep['message'])
@@ -30,7 +36,7 @@ def get_my_uid():
 
 def get_dynamic_list(mid, offset=''):
     url = f'https://api.bilibili.com/x/polymer/web-dynamic/v1/feed/space?host_mid={mid}&offset={offset}'
-    req = requests.get(url, headers=headers, cookies=cookies)
+    req = requests.get(api_url(url), headers=headers, cookies=cookies)
     print(url)
     rep = json.loads(req.text)
     if rep['code'] != 0:
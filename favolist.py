@@ -5,8 +5,12 @@ import queue
 import json
 import os
 
-with open(os.path.expanduser('.bilibili-cookies.json'), 'r') as f:
-    cookies = json.load(f)
+from biliapi import api_url
+
+cookies = {}
+if os.path.exists('.bilibili-cookies.json'):
+    with open('.bilibili-cookies.json', 'r') as f:
+        cookies = json.load(f)
 
 
 def fetchvideo(title, bvid, mode='av', postfix=''):
@@ -55,8 +59,8 @@ def getfavlist(favid):
     pn = 1
     while True:
         res_data = requests.get(
-            'https://api.bilibili.com/x/v3/fav/resource/list?media_id={}&ps={}&pn={}'
-            .format(favid, ps, pn),
+            api_url('https://api.bilibili.com/x/v3/fav/resource/list?media_id={}&ps={}&pn={}'
+                    .format(favid, ps, pn)),
             headers=headers,
             cookies=cookies)
         res = json.loads(res_data.text)
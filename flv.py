@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import struct
+
+FLV_HEADER = b'FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00'
+
+TAG_AUDIO = 8
+TAG_VIDEO = 9
+TAG_SCRIPT = 18
+
+class FlvTag:
+    __slots__ = ('kind', 'timestamp', 'data', 'keyframe', 'config')
+
+    def __init__(self, kind, timestamp, data, keyframe, config):
+        self.kind = kind
+        self.timestamp = timestamp
+        self.data = data          # 完整的 tag，包括 11 字节的 tag 头和末尾的 PreviousTagSize
+        self.keyframe = keyframe  # 视频关键帧，新的客户端或分段从这里开始
+        self.config = config      # metadata 和音视频的 sequence header，新的客户端或分段要先收到这些
+
+def pack_timestamp(timestamp):
+    '低 24 位在前，高 8 位放在扩展字节里'
+    return (timestamp & 0xffffff).to_bytes(3, 'big') + bytes(((timestamp >> 24) & 0xff,))
+
+def make_tag(kind, timestamp, body):
+    size = len(body)
+    return bytes((kind,)) + size.to_bytes(3, 'big') + pack_timestamp(timestamp) + b'\0\0\0' + body + struct.pack('>I', size + 11)
+
+def with_timestamp(data, timestamp):
+    '返回改了时间戳的 tag'
+    return data[:4] + pack_timestamp(timestamp) + data[8:]
+
+class FlvParser:
+    '''把 FLV 字节流切成完整的 tag
+
+    上游断开重连后，新连接会从文件头和时间戳 0 重新开始；调用 reconnect() 后，
+    新连接的文件头会被去掉，时间戳接在上一段后面，下游看到的始终是一条连续的流。
+    只缓存一个不完整的 tag，内存占用和流的长度无关
+    '''
+    def __init__(self):
+        self.pending = bytearray()
+        self.need_header = True
+        self.offset = 0       # 加到本次连接时间戳上的偏移
+        self.first = None     # 本次连接第一个 tag 的时间戳
+        self.last = -1        # 已输出的最大时间戳
+
+    def reconnect(self):
+        self.pending.clear()
+        self.need_header = True
+        self.first = None
+
+    def feed(self, chunk):
+        self.pending += chunk
+        buf = self.pending
+        pos = 0
+        tags = []
+        if self.need_header:
+            if len(buf) < len(FLV_HEADER):
+                return tags
+            if buf[:3] != b'FLV':
+                raise ValueError('不是 FLV 流')
+            pos = int.from_bytes(buf[5:9], 'big') + 4
+            self.need_header = False
+        while len(buf) - pos >= 11:
+            kind = buf[pos] & 0x1f
+            size = int.from_bytes(buf[pos + 1:pos + 4], 'big')
+            end = pos + 11 + size + 4
+            if end > len(buf):
+                break
+            if kind not in (TAG_AUDIO, TAG_VIDEO, TAG_SCRIPT):
+                raise ValueError(f'FLV tag 类型错误：{kind}')
+            timestamp = int.from_bytes(buf[pos + 4:pos + 7], 'big') | (buf[pos + 7] << 24)
+            body = pos + 11
+            keyframe = kind == TAG_VIDEO and size > 0 and buf[body] >> 4 == 1
+            config = (kind == TAG_SCRIPT
+                      or kind == TAG_VIDEO and size > 1 and buf[body] & 0x0f == 7 and buf[body + 1] == 0
+                      or kind == TAG_AUDIO and size > 1 and buf[body] >> 4 == 10 and buf[body + 1] == 0)
+            if self.first is None and not config:
+                # 重连后的第一帧紧接在上一段之后
+                self.first = timestamp
+                self.offset = self.last + 1 - timestamp if self.last >= 0 else 0
+            new_timestamp = max(timestamp + self.offset, 0) if self.first is not None else max(self.last, 0)
+            data = bytes(buf[pos:end])
+            if new_timestamp != timestamp:
+                data = with_timestamp(data, new_timestamp)
+            if not config:
+                self.last = max(self.last, new_timestamp)
+            tags.append(FlvTag(kind, new_timestamp, data, keyframe, config))
+            pos = end
+        del buf[:pos]
+        return tags
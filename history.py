@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import traceback
+import threading
+import argparse
+import sqlite3
+import queue
+import time
+import sys
+import re
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS danmu (
+    id INTEGER PRIMARY KEY,
+    room INTEGER NOT NULL,
+    msg_id TEXT NOT NULL,
+    uid INTEGER,
+    nickname TEXT,
+    text TEXT,
+    time INTEGER,
+    medal_level INTEGER,
+    medal_name TEXT,
+    UNIQUE (room, msg_id)
+);
+CREATE INDEX IF NOT EXISTS danmu_uid_time ON danmu (uid, time);
+CREATE INDEX IF NOT EXISTS danmu_room_time ON danmu (room, time);
+CREATE INDEX IF NOT EXISTS danmu_time ON danmu (time);
+CREATE INDEX IF NOT EXISTS danmu_nickname ON danmu (nickname);
+CREATE TRIGGER IF NOT EXISTS danmu_fts_insert AFTER INSERT ON danmu BEGIN
+    INSERT INTO danmu_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS danmu_fts_delete AFTER DELETE ON danmu BEGIN
+    INSERT INTO danmu_fts (danmu_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+'''
+
+def connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    try:
+        # trigram 分词可以对没有空格的中文做子串搜索，需要 SQLite 3.34+
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS danmu_fts USING fts5(text, content='danmu', content_rowid='id', tokenize='trigram')")
+    except sqlite3.OperationalError:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS danmu_fts USING fts5(text, content='danmu', content_rowid='id')")
+    conn.executescript(SCHEMA)
+    return conn
+
+class HistoryStore:
+    '''把收到的弹幕保存到 SQLite
+
+    add() 只把弹幕放进队列，由后台线程每隔 flush_interval 秒批量写入一次，
+    退出或换文件前要调用 close()，否则最后不到 flush_interval 秒的弹幕会丢失
+    '''
+    def __init__(self, path, flush_interval=1.0, batch_size=500):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.conn = connect(path)
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def add(self, room, messages):
+        for m in messages:
+            medal = m.medal or (None, None)
+            self.queue.put((room, str(m.id), m.uid, m.nickname, m.text, m.timestamp, medal[0], medal[1]))
+
+    def writer(self):
+        closing = False
+        while not closing:
+            row = self.queue.get()
+            if row is None:
+                break
+            rows = [row]
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    # 关闭前先把已经取出的弹幕写完
+                    closing = True
+                    break
+                rows.append(row)
+            try:
+                with self.conn:
+                    self.conn.executemany('INSERT OR IGNORE INTO danmu (room, msg_id, uid, nickname, text, time, medal_level, medal_name) '
+                                          'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    def close(self):
+        '写完队列中剩下的弹幕，停止后台线程并关闭数据库，可以重复调用'
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.conn.close()
+
+def parse_time(value) -> int:
+    '支持 2024-01-01、2024-01-01 12:00[:00]、Unix 时间戳，或者 30m、2h、7d 这样的相对时间'
+    m = re.fullmatch(r'(\d+)([smhd])', value)
+    if m:
+        return int(time.time()) - int(m.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[m.group(2)]
+    if value.isdigit():
+        return int(value)
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(value, fmt)))
+        except ValueError:
+            pass
+    raise ValueError(f'无法识别的时间：{value}')
+
+def query(conn, user=None, room=None, since=None, until=None, grep=None, limit=100):
+    '按条件查询历史弹幕，按时间从旧到新返回最近的 limit 条'
+    where = []
+    params = []
+    if user is not None:
+        if str(user).isdigit():
+            where.append('danmu.uid = ?')
+            params.append(int(user))
+        else:
+            where.append('danmu.nickname = ?')
+            params.append(user)
+    if room is not None:
+        where.append('danmu.room = ?')
+        params.append(int(room))
+    if since is not None:
+        where.append('danmu.time >= ?')
+        params.append(since)
+    if until is not None:
+        where.append('danmu.time < ?')
+        params.append(until)
+    table = 'danmu'
+    if grep:
+        if len(grep) >= 3:
+            table = 'danmu_fts JOIN danmu ON danmu.id = danmu_fts.rowid'
+            where.append('danmu_fts MATCH ?')
+            params.append('"' + grep.replace('"', '""') + '"')
+        else:
+            # trigram 索引只能搜索三个字以上的词，更短的只能扫描
+            where.append("danmu.text LIKE ? ESCAPE '\\'")
+            params.append('%' + re.sub(r'([%_\\])', r'\\\1', grep) + '%')
+    sql = f'SELECT danmu.room, danmu.uid, danmu.nickname, danmu.text, danmu.time FROM {table}'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY danmu.time DESC, danmu.id DESC LIMIT ?'
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()[::-1]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='danmu.py history', description='查询本地保存的历史弹幕')
+    parser.add_argument('--db', default='.bilibili-history.db', help='数据库文件')
+    parser.add_argument('--user', help='用户 uid 或昵称')
+    parser.add_argument('--room', type=int, help='直播间号')
+    parser.add_argument('--since', help='起始时间，如 2024-01-01 或 2h')
+    parser.add_argument('--until', help='结束时间')
+    parser.add_argument('--grep', help='弹幕中包含的文字')
+    parser.add_argument('--limit', type=int, default=100, help='最多显示条数')
+    args = parser.parse_args(argv)
+    conn = connect(args.db)
+    started = time.perf_counter()
+    rows = query(conn, user=args.user, room=args.room,
+                 since=parse_time(args.since) if args.since else None,
+                 until=parse_time(args.until) if args.until else None,
+                 grep=args.grep, limit=args.limit)
+    elapsed = time.perf_counter() - started
+    for room, uid, nickname, text, timestamp in rows:
+        print(f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))} [{room}] {nickname}({uid}) : {text}')
+    print(f'共 {len(rows)} 条，用时 {elapsed * 1000:.1f} ms', file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
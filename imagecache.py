@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import concurrent.futures
+import collections
+import traceback
+import threading
+import hashlib
+import time
+import os
+
+from PySide2.QtGui import QImage, QPixmap
+from PySide2.QtCore import QObject, Signal, QUrl, Qt
+
+from danmufile import atomic_write
+
+class DiskCache:
+    '''按内容寻址的图片磁盘缓存
+
+    blobs/<sha256> 保存图片内容，urls/<sha1(url)> 记录 URL 对应的内容哈希，同一张图换了 URL 也只存一份。
+    总大小超过 budget 字节时按最近访问时间删除最旧的内容
+    '''
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.blobs = None  # 内容哈希 -> [大小, 最近访问时间]，第一次使用时扫描目录
+        self.total = 0
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest)
+
+    def url_path(self, url):
+        return os.path.join(self.directory, 'urls', hashlib.sha1(url.encode()).hexdigest())
+
+    def scan(self):
+        if self.blobs is not None:
+            return
+        os.makedirs(os.path.join(self.directory, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, 'urls'), exist_ok=True)
+        self.blobs = {}
+        with os.scandir(os.path.join(self.directory, 'blobs')) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    st = entry.stat()
+                    self.blobs[entry.name] = [st.st_size, st.st_mtime]
+        self.total = sum(size for size, _ in self.blobs.values())
+
+    def path_for_url(self, url):
+        '已缓存时返回图片文件路径，并更新访问时间'
+        with self.lock:
+            self.scan()
+            try:
+                with open(self.url_path(url), 'r') as f:
+                    digest = f.read().strip()
+            except OSError:
+                return None
+            blob = self.blobs.get(digest)
+            if blob is None:
+                return None
+            blob[1] = time.time()
+        path = self.blob_path(digest)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, url, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        with self.lock:
+            self.scan()
+            if digest not in self.blobs:
+                atomic_write(path, data)
+                self.blobs[digest] = [len(data), time.time()]
+                self.total += len(data)
+            atomic_write(self.url_path(url), digest.encode())
+            self.evict(keep=digest)
+        return path
+
+    def evict(self, keep=None):
+        if self.total <= self.budget:
+            return
+        # urls/ 下指向已删除内容的记录会在下次读取时当作未命中，不用逐个清理
+        for digest, (size, _) in sorted(self.blobs.items(), key=lambda item: item[1][1]):
+            if self.total <= self.budget:
+                break
+            if digest == keep:
+                continue
+            try:
+                os.unlink(self.blob_path(digest))
+            except OSError:
+                pass
+            del self.blobs[digest]
+            self.total -= size
+
+class ImageCache(QObject):
+    '''头像和表情图片缓存，供弹幕视图共用
+
+    内存中按 LRU 保存解码后的 QPixmap，总字节数不超过 memory_budget；下面是 DiskCache。
+    pixmap()/file_url() 只在 GUI 线程中调用，未缓存时返回 None 并在后台下载，
+    同一 URL 同时只会下载一次，完成后发出 ready(url) 信号，视图此时再重绘
+    '''
+    ready = Signal(str)
+    loaded = Signal(str, object, object)
+
+    def __init__(self, fetch, directory, memory_budget=32 << 20, disk_budget=128 << 20,
+                 max_size=128, workers=2, retry_after=60):
+        super().__init__()
+        self.fetch = fetch
+        self.disk = DiskCache(directory, disk_budget)
+        self.memory_budget = memory_budget
+        self.max_size = max_size
+        self.retry_after = retry_after
+        # 单独的线程池，批量下载图片时不会挤占界面操作用的线程
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image')
+        self.pixmaps = collections.OrderedDict()
+        self.memory_used = 0
+        self.paths = collections.OrderedDict()
+        self.pending = set()
+        self.failed = {}
+        self.downloads = 0
+        self.loaded.connect(self.on_loaded)
+
+    def pixmap(self, url):
+        pixmap = self.pixmaps.get(url)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(url)
+            return pixmap
+        self.request(url)
+        return None
+
+    def file_url(self, url):
+        '图片已在磁盘缓存中时返回 file:// 地址，给网页视图用'
+        path = self.paths.get(url)
+        if path is not None:
+            # 磁盘缓存超出预算时可能已经删掉了这个文件，这时重新下载
+            if os.path.exists(path):
+                self.paths.move_to_end(url)
+                return QUrl.fromLocalFile(os.path.abspath(path)).toString()
+            del self.paths[url]
+        self.request(url)
+        return None
+
+    def request(self, url):
+        if url in self.pending or self.failed.get(url, 0) > time.monotonic():
+            return
+        self.pending.add(url)
+        self.pool.submit(self.load, url)
+
+    def load(self, url):
+        path = image = None
+        try:
+            path = self.disk.path_for_url(url)
+            if path is None:
+                self.downloads += 1
+                path = self.disk.put(url, self.fetch(url))
+            image = QImage(path)
+            if image.isNull():
+                image = None
+            elif max(image.width(), image.height()) > self.max_size:
+                image = image.scaled(self.max_size, self.max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        except Exception:
+            traceback.print_exc()
+        self.loaded.emit(url, path, image)
+
+    def on_loaded(self, url, path, image):
+        self.pending.discard(url)
+        if image is None:
+            self.failed[url] = time.monotonic() + self.retry_after
+            return
+        self.failed.pop(url, None)
+        self.paths[url] = path
+        while len(self.paths) > 4096:
+            self.paths.popitem(last=False)
+        pixmap = QPixmap.fromImage(image)
+        old = self.pixmaps.pop(url, None)
+        if old is not None:
+            # 同一 URL 重新加载（比如文件被删后重新下载）时不能重复计算大小
+            self.memory_used -= pixmap_bytes(old)
+        self.pixmaps[url] = pixmap
+        self.memory_used += pixmap_bytes(pixmap)
+        while self.memory_used > self.memory_budget and len(self.pixmaps) > 1:
+            _, old = self.pixmaps.popitem(last=False)
+            self.memory_used -= pixmap_bytes(old)
+        self.ready.emit(url)
+
+def pixmap_bytes(pixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
@@ -16,6 +16,8 @@ import sys
 import io
 import os
 
+from biliapi import api_url
+
 # with open(os.path.expanduser('~/.bilibili-cookies.json'), 'r') as f:
 #     cookies = {item['name']: item['value'] for item in json.load(f)}
 
@@ -26,14 +28,20 @@ headers = {
     'Content-Type': 'application/x-www-form-urlencoded',
 }
 
-with open('.bilibili-cookies.json', 'r') as f:
-    cookies = json.load(f)
+# 所有接口请求的 (连接, 读取) 超时，连接卡住时 --watch/--serve/--record 才能重试而不是一直等下去
+timeout = (5, 10)
+
+if os.path.exists('.bilibili-cookies.json'):
+    with open('.bilibili-cookies.json', 'r') as f:
+        cookies = json.load(f)
+else:
+    cookies = {}
 # with open('.cookies.json', 'r') as f:
 #     cookies = {x['name']: x['value'] for x in json.load(f)}
 
 def get_my_uid():
     url = 'https://api.bilibili.com/x/web-interface/nav'
-    req = requests.get(url, headers=headers, cookies=cookies)
+    req = requests.get(api_url(url), headers=headers, cookies=cookies, timeout=timeout)
     rep = json.loads(req.text)
     if rep['code'] != 0:
         raise RuntimeError(rep['message'])
@@ -82,18 +90,29 @@ def get_device_id():
 
 def get_live_info(roomId):
     url = f'https://api.live.bilibili.com/room/v1/Room/get_info?room_id={roomId}'
-    req = requests.get(url, headers=headers, cookies=cookies)
+    req = requests.get(api_url(url), headers=headers, cookies=cookies, timeout=timeout)
     rep = json.loads(req.text)
     if rep['code'] != 0:
         raise RuntimeError(rep['message'])
     data = rep['data']
     return data
 
+def get_status_info_by_uids(uids):
+    '按主播 uid 批量查询直播状态，返回 {str(uid): 直播间信息}，查不到的 uid 不在其中'
+    url = 'https://api.live.bilibili.com/room/v1/Room/get_status_info_by_uids'
+    req = requests.get(api_url(url), params=[('uids[]', uid) for uid in uids], headers=headers, cookies=cookies, timeout=timeout)
+    rep = json.loads(req.text)
+    if rep['code'] != 0:
+        raise RuntimeError(rep['message'])
+    data = rep['data']
+    # 一个都查不到时返回的是空列表
+    return data or {}
+
 def get_live_stream(roomId, quality=4):  # 3: 高清，4：原画
     info = get_live_info(roomId)
     cid = info['room_id']
     url = f'https://api.live.bilibili.com/room/v1/Room/playUrl?cid={cid}&platform=html5&quality={quality}'
-    req = requests.get(url, headers=headers, cookies=cookies)
+    req = requests.get(api_url(url), headers=headers, cookies=cookies, timeout=timeout)
     rep = json.loads(req.text)
     if rep['code'] != 0:
         raise RuntimeError(rep['message'])
@@ -102,7 +121,7 @@ def get_live_stream(roomId, quality=4):  # 3: 高清，4：原画
 
 def get_video_info(bvid):
     url = f'https://api.bilibili.com/x/player/pagelist?bvid={bvid}'
-    req = requests.get(url, headers=headers, cookies=cookies)
+    req = requests.get(api_url(url), headers=headers, cookies=cookies, timeout=timeout)
     rep = json.loads(req.text)
     if rep['code'] != 0:
         raise RuntimeError(rep['message'])
@@ -116,7 +135,7 @@ def get_video_stream(bvid, qn=116, page=1, dash=False):
     print(info['part'], '{:02d}:{:02d}'.format(info['duration'] // 60, info['duration'] % 60))
     cid = info['cid']
     url = f'https://api.bilibili.com/x/player/playurl?bvid={bvid}&cid={cid}&qn={qn}&fnval={80 if dash else 1}&fnver=0&fourk=1'
-    req = requests.get(url, headers=headers, cookies=cookies)
+    req = requests.get(api_url(url), headers=headers, cookies=cookies, timeout=timeout)
     print(url)
     rep = json.loads(req.text)
     if rep['code'] != 0:
@@ -140,7 +159,69 @@ if __name__ == '__main__':
     #     chunk = p1.stdout.read(4096)
     #     p2.stdin.write(chunk)
 
-    roomId = sys.argv[1]
+    import argparse
+    parser = argparse.ArgumentParser(description='B站直播工具')
+    parser.add_argument('room', nargs='*', help='直播间号')
+    parser.add_argument('--watch', action='store_true', help='监视这些直播间，开播、下播时提示')
+    parser.add_argument('--exec', dest='hook', help='--watch 时开播、下播执行的命令，环境变量 LIVE_ROOM、LIVE_UID、LIVE_STATUS（live/offline）、LIVE_TITLE')
+    parser.add_argument('--room-file', help='--watch 时从文件中读取直播间号，每行一个')
+    parser.add_argument('--serve', action='store_true', help='只拉一份直播流，通过本机 HTTP 分发给多个播放器')
+    parser.add_argument('--host', default='127.0.0.1', help='--serve 时监听的地址')
+    parser.add_argument('--port', type=int, default=8081, help='--serve 时监听的端口')
+    parser.add_argument('--record', action='store_true', help='分段录制直播，断线自动重连，没开播时等待开播')
+    parser.add_argument('--output', help='--record 时保存录像的目录，默认 recordings/<直播间号>')
+    parser.add_argument('--segment-duration', type=float, default=30, help='--record 时每段的时长（分钟），0 为不按时长分段')
+    parser.add_argument('--segment-size', type=float, default=0, help='--record 时每段的大小（MB），0 为不按大小分段')
+    args = parser.parse_args()
+
+    if args.watch:
+        from livewatch import LiveWatcher
+        rooms = list(args.room)
+        if args.room_file:
+            with open(args.room_file, 'r') as f:
+                rooms += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+        def on_change(roomId, is_live, info):
+            print(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), roomId, '开播了' if is_live else '下播了', info.get('title', ''))
+            if args.hook:
+                env = dict(os.environ, LIVE_ROOM=str(roomId), LIVE_UID=str(info.get('uid', '')),
+                           LIVE_STATUS='live' if is_live else 'offline', LIVE_TITLE=info.get('title', ''))
+                subprocess.Popen(args.hook, shell=True, env=env)
+
+        watcher = LiveWatcher(rooms, on_change)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        print(f'共发出 {watcher.requests} 次请求')
+        sys.exit(0)
+
+    if len(args.room) != 1:
+        parser.error('请指定一个直播间号')
+    roomId = args.room[0]
+
+    stream_headers = {'User-Agent': headers['User-Agent'], 'Referer': 'https://live.bilibili.com/'}
+
+    if args.record:
+        from liverecord import LiveRecorder
+        recorder = LiveRecorder(lambda: get_live_stream(roomId), args.output or os.path.join('recordings', roomId), roomId,
+                                stream_headers, args.segment_duration * 60, int(args.segment_size * 1e6))
+        try:
+            recorder.run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if args.serve:
+        from liverelay import LiveRelay, serve
+        server = serve(LiveRelay(lambda: get_live_stream(roomId), stream_headers), args.port, args.host)
+        print(f'直播流地址：http://{args.host}:{server.server_address[1]}/live.flv')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
     url = get_live_stream(roomId)
     print(url)
     subprocess.check_call(['vlc', url], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
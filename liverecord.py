@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import traceback
+import threading
+import requests
+import json
+import time
+import os
+
+import flv
+from danmufile import atomic_write
+
+class Segment:
+    __slots__ = ('path', 'file', 'started', 'first_ts', 'last_ts', 'size')
+
+    def __init__(self, path, started, first_ts):
+        self.path = path
+        self.file = open(path, 'wb', buffering=256 << 10)
+        self.started = started
+        self.first_ts = first_ts
+        self.last_ts = first_ts
+        self.size = 0
+
+    @property
+    def duration(self):
+        return (self.last_ts - self.first_ts) / 1000
+
+class LiveRecorder:
+    '''无人值守的分段直播录制
+
+    边下载边按 FLV tag 写入文件，内存中只有一个下载块和一个不完整的 tag，录多久都不会增长。
+    超过 segment_duration 秒或 segment_size 字节后在下一个关键帧处开始新的分段，
+    每段都以文件头和 sequence header 开头、时间戳从 0 开始，可以单独播放。
+    CDN 断开时重新获取 playUrl 接着录，没开播时每隔 retry_interval 秒再试；
+    index.json 记录每段的文件名、开始时间、时长和大小
+    '''
+    def __init__(self, resolve, directory, prefix='live', headers=None,
+                 segment_duration=1800, segment_size=0, retry_interval=30, chunk_size=64 << 10):
+        self.resolve = resolve
+        self.directory = directory
+        self.prefix = prefix
+        self.headers = headers or {}
+        self.segment_duration = segment_duration
+        self.segment_size = segment_size
+        self.retry_interval = retry_interval
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        self.stopped = threading.Event()
+        self.segment = None
+        self.config = {}
+        self.config_changed = False
+        self.index_path = os.path.join(directory, 'index.json')
+        self.index = self.load_index()
+        self.bytes_written = 0
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def save_index(self):
+        atomic_write(self.index_path, json.dumps(self.index, ensure_ascii=False, indent=1).encode('utf-8'))
+
+    def open_segment(self, tag):
+        started = time.time()
+        name = f'{self.prefix}-{time.strftime("%Y%m%d-%H%M%S", time.localtime(started))}.flv'
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            name = f'{name[:-4]}-{int(started * 1000) % 1000:03d}.flv'
+            path = os.path.join(self.directory, name)
+        self.segment = Segment(path, started, tag.timestamp)
+        self.config_changed = False
+        self.write(flv.FLV_HEADER)
+        for kind in (flv.TAG_SCRIPT, flv.TAG_VIDEO, flv.TAG_AUDIO):
+            if kind in self.config:
+                self.write(flv.with_timestamp(self.config[kind], 0))
+        self.index.append({'file': name, 'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+                           'start_time': started, 'duration': 0, 'size': 0})
+        self.save_index()
+        print(f'开始录制 {path}')
+
+    def close_segment(self):
+        segment = self.segment
+        if segment is None:
+            return
+        self.segment = None
+        segment.file.close()
+        self.index[-1].update(duration=segment.duration, size=segment.size)
+        self.save_index()
+        print(f'录制完成 {segment.path}，{segment.duration:.0f} 秒，{segment.size / 1e6:.1f} MB')
+
+    def write(self, data):
+        self.segment.file.write(data)
+        self.segment.size += len(data)
+        self.bytes_written += len(data)
+
+    def segment_full(self):
+        segment = self.segment
+        return (self.config_changed
+                or self.segment_duration and segment.duration >= self.segment_duration
+                or self.segment_size and segment.size >= self.segment_size)
+
+    def on_tag(self, tag):
+        if tag.config:
+            if self.config.get(tag.kind, b'')[11:] != tag.data[11:]:
+                # 分辨率等参数变了，新的 sequence header 要从下一段开头写起
+                self.config_changed = self.segment is not None
+                self.config[tag.kind] = tag.data
+            return
+        if tag.keyframe and (self.segment is None or self.segment_full()):
+            self.close_segment()
+            self.open_segment(tag)
+        if self.segment is None:
+            return  # 等第一个关键帧
+        self.write(flv.with_timestamp(tag.data, tag.timestamp - self.segment.first_ts))
+        self.segment.last_ts = tag.timestamp
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        parser = flv.FlvParser()
+        backoff = 0
+        try:
+            while not self.stopped.is_set():
+                parser.reconnect()
+                received = False
+                try:
+                    url = self.resolve()
+                    with self.session.get(url, headers=self.headers, stream=True, timeout=(10, 30)) as resp:
+                        resp.raise_for_status()
+                        for chunk in resp.iter_content(self.chunk_size):
+                            for tag in parser.feed(chunk):
+                                self.on_tag(tag)
+                            received = True
+                            backoff = 0
+                            if self.stopped.is_set():
+                                break
+                except Exception as e:
+                    print(f'直播流获取失败：{e!r}')
+                    if not isinstance(e, (requests.RequestException, RuntimeError, ValueError, LookupError)):
+                        traceback.print_exc()
+                if received:
+                    # CDN 断开了连接，马上重新获取地址接着录
+                    continue
+                # 连不上时多半是下播了，先把当前分段收尾
+                self.close_segment()
+                parser = flv.FlvParser()
+                backoff = min(backoff * 2 or 1, self.retry_interval)
+                self.stopped.wait(backoff)
+        finally:
+            self.close_segment()
+
+    def stop(self):
+        self.stopped.set()
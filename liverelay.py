@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import http.server
+import collections
+import traceback
+import threading
+import itertools
+import requests
+import socket
+import json
+import time
+
+import flv
+
+class SlowClient(Exception):
+    pass
+
+class StreamBuffer:
+    '''直播流的共享环形缓冲区
+
+    按 FLV tag 保存最近 capacity 字节，每个 tag 有一个递增的序号。所有客户端共用同一份数据，
+    各自只记住读到哪个序号；要读的数据已经被覆盖的客户端（落后太多）会收到 SlowClient，
+    上游和其他客户端完全不受它影响
+    '''
+    def __init__(self, capacity=16 << 20):
+        self.capacity = capacity
+        self.cond = threading.Condition()
+        self.items = collections.deque()
+        self.first = 0  # items[0] 的序号
+        self.size = 0
+        self.keyframes = collections.deque()  # 缓冲区中关键帧的序号
+        self.config = {}  # tag 类型 -> 最新的 metadata 或 sequence header
+
+    def append(self, tag):
+        with self.cond:
+            if tag.config:
+                self.config[tag.kind] = tag.data
+            if tag.keyframe:
+                self.keyframes.append(self.first + len(self.items))
+            self.items.append(tag.data)
+            self.size += len(tag.data)
+            while self.size > self.capacity and len(self.items) > 1:
+                self.size -= len(self.items.popleft())
+                self.first += 1
+            while self.keyframes and self.keyframes[0] < self.first:
+                self.keyframes.popleft()
+            self.cond.notify_all()
+
+    def reset(self):
+        '上游停止后清空，下次连接是一条新的流'
+        with self.cond:
+            self.first += len(self.items)
+            self.items.clear()
+            self.keyframes.clear()
+            self.config.clear()
+            self.size = 0
+
+    def read(self, seq, timeout):
+        '''返回 (下一个序号, 数据列表)，超时返回空列表
+
+        seq 为 None 表示新客户端：等到有关键帧后从最近的关键帧开始，并先发送文件头和 sequence header
+        '''
+        with self.cond:
+            head = []
+            if seq is None:
+                if not self.cond.wait_for(lambda: self.keyframes, timeout):
+                    return None, []
+                seq = self.keyframes[-1]
+                head = [flv.FLV_HEADER] + [self.config[k] for k in (flv.TAG_SCRIPT, flv.TAG_VIDEO, flv.TAG_AUDIO) if k in self.config]
+            elif not self.cond.wait_for(lambda: self.first + len(self.items) > seq, timeout):
+                return seq, []
+            if seq < self.first:
+                raise SlowClient(seq)
+            data = list(itertools.islice(self.items, seq - self.first, None))
+            return seq + len(data), head + data
+
+class LiveRelay:
+    '''只从上游拉一份直播流，分发给本机任意多个客户端
+
+    有客户端时才连接上游，最后一个客户端断开 linger 秒后断开上游。
+    上游断开或 CDN 地址过期时重新调用 resolve() 获取地址并重连，客户端看到的是一条连续的流
+    '''
+    def __init__(self, resolve, headers=None, capacity=16 << 20, linger=30, write_timeout=10, chunk_size=64 << 10):
+        self.resolve = resolve
+        self.headers = headers or {}
+        self.buffer = StreamBuffer(capacity)
+        self.linger = linger
+        self.write_timeout = write_timeout
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.idle_since = time.monotonic()
+        self.demand = threading.Event()
+        self.stats = collections.Counter()
+
+    def add_client(self):
+        with self.lock:
+            self.clients += 1
+            self.stats['clients_total'] += 1
+        self.demand.set()
+
+    def remove_client(self):
+        with self.lock:
+            self.clients -= 1
+            if self.clients == 0:
+                self.idle_since = time.monotonic()
+
+    def idle(self):
+        with self.lock:
+            return self.clients == 0 and time.monotonic() - self.idle_since > self.linger
+
+    def run_upstream(self):
+        parser = None
+        backoff = 0
+        while True:
+            self.demand.wait()
+            if parser is None:
+                parser = flv.FlvParser()
+            else:
+                parser.reconnect()
+            try:
+                url = self.resolve()
+                with self.session.get(url, headers=self.headers, stream=True, timeout=(10, 30)) as resp:
+                    resp.raise_for_status()
+                    self.stats['connects'] += 1
+                    for chunk in resp.iter_content(self.chunk_size):
+                        for tag in parser.feed(chunk):
+                            self.buffer.append(tag)
+                        self.stats['bytes_in'] += len(chunk)
+                        backoff = 0
+                        if self.idle():
+                            break
+            except Exception:
+                traceback.print_exc()
+                self.stats['errors'] += 1
+            if self.idle():
+                self.demand.clear()
+                self.buffer.reset()
+                parser = None
+                continue
+            # CDN 断开连接时立即重连，连续出错时逐渐退避
+            time.sleep(backoff)
+            backoff = min(backoff * 2 or 1, 30)
+
+    def serve_client(self, wfile):
+        self.add_client()
+        seq = None
+        try:
+            while True:
+                seq, data = self.buffer.read(seq, timeout=30)
+                if data:
+                    wfile.write(b''.join(data))
+                    self.stats['bytes_out'] += sum(map(len, data))
+        except (SlowClient, socket.timeout):
+            self.stats['clients_dropped'] += 1
+        except OSError:
+            pass
+        finally:
+            self.remove_client()
+
+    def status(self):
+        with self.lock:
+            clients = self.clients
+        return dict(self.stats, clients=clients, buffered=self.buffer.size)
+
+class RelayHandler(http.server.BaseHTTPRequestHandler):
+    relay: LiveRelay = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/status':
+            body = json.dumps(self.relay.status()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path not in ('/', '/live.flv'):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/x-flv')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        # 写不出去（客户端卡住）超过 write_timeout 秒就断开，只影响这一个客户端
+        self.connection.settimeout(self.relay.write_timeout)
+        self.relay.serve_client(self.wfile)
+
+def serve(relay, port=8081, host='127.0.0.1'):
+    '启动上游线程和 HTTP 服务器，返回服务器，调用 serve_forever() 开始服务'
+    handler = type('Handler', (RelayHandler,), {'relay': relay})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=relay.run_upstream, daemon=True).start()
+    return server
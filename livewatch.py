@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import traceback
+import threading
+import json
+import time
+import os
+
+import live
+from danmufile import atomic_write
+
+class WatchedRoom:
+    __slots__ = ('roomid', 'uid', 'live', 'info', 'interval', 'next_check', 'hot_until', 'starts')
+
+    def __init__(self, roomid, uid=None, starts=()):
+        self.roomid = roomid
+        self.uid = uid
+        self.live = None  # 还没查询过时为 None
+        self.info = {}
+        self.interval = 0
+        self.next_check = 0.0
+        self.hot_until = 0.0
+        self.starts = list(starts)  # 最近几次开播的时刻（当天的第几秒）
+
+def seconds_of_day(t):
+    tm = time.localtime(t)
+    return tm.tm_hour * 3600 + tm.tm_min * 60 + tm.tm_sec
+
+class LiveWatcher:
+    '''批量监视多个直播间的开播状态
+
+    每个直播间第一次通过 live.get_live_info 查出主播 uid，之后用 get_status_info_by_uids 按 uid 批量查询，
+    一次请求最多 batch_size 个直播间，并把 slack 秒内即将到期的直播间合并进同一次请求。
+    每个直播间的检查间隔各自调整：刚下播的 hot_period 秒内、以及接近它平时开播的时刻时用 min_interval，
+    其余没开播的用 offline_interval（200 个直播间每分钟约 4 次请求），正在直播的用 base_interval。
+    查不到 uid 的直播间按 min_interval 起翻倍退避重试，最长 max_interval。
+    开播、下播时调用 on_change(roomid, live, info)，第一次查询到的状态不算变化
+    '''
+    def __init__(self, roomids, on_change=None, state_file='.bilibili-livewatch.json',
+                 min_interval=15, offline_interval=30, base_interval=60, max_interval=600, batch_size=100,
+                 hot_period=600, start_window=1200, resolve_per_second=2):
+        self.on_change = on_change
+        self.state_file = state_file
+        self.min_interval = min_interval
+        self.offline_interval = offline_interval
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self.slack = min_interval
+        self.hot_period = hot_period
+        self.start_window = start_window
+        self.resolve_per_second = resolve_per_second
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.rooms = {}
+        self.requests = 0
+        self.backoff = 0
+        state = self.load_state()
+        for roomid in roomids:
+            saved = state.get(str(roomid), {})
+            self.rooms[int(roomid)] = WatchedRoom(int(roomid), saved.get('uid'), saved.get('starts', ()))
+
+    def load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            traceback.print_exc()
+            return {}
+
+    def save_state(self):
+        if not self.state_file:
+            return
+        with self.lock:
+            state = {str(r.roomid): {'uid': r.uid, 'starts': r.starts} for r in self.rooms.values() if r.uid}
+        try:
+            atomic_write(self.state_file, json.dumps(state).encode())
+        except OSError:
+            traceback.print_exc()
+
+    def add(self, roomid):
+        with self.lock:
+            self.rooms.setdefault(int(roomid), WatchedRoom(int(roomid)))
+
+    def remove(self, roomid):
+        with self.lock:
+            self.rooms.pop(int(roomid), None)
+
+    def status(self, roomid):
+        '返回 True/False，还没查询过时返回 None'
+        room = self.rooms.get(int(roomid))
+        return room.live if room is not None else None
+
+    def near_usual_start(self, room, wall_time):
+        'wall_time 是 time.time() 的时间，starts 记录的也是当天的钟点'
+        if not room.starts:
+            return False
+        t = seconds_of_day(wall_time)
+        # 跨零点时也要算对距离
+        return any(min(abs(t - s), 86400 - abs(t - s)) <= self.start_window for s in room.starts)
+
+    def next_interval(self, room, now):
+        'now 是 time.monotonic()，和 hot_until、next_check 比较；是否接近平时开播的时刻要按钟点算'
+        if now < room.hot_until or (not room.live and self.near_usual_start(room, time.time())):
+            return self.min_interval
+        if room.live:
+            return self.base_interval
+        return self.offline_interval
+
+    def update(self, room, info, now):
+        is_live = info.get('live_status') == 1  # 2 是轮播，当作没开播
+        changed = room.live is not None and room.live != is_live
+        room.live = is_live
+        room.info = info
+        if changed:
+            if is_live:
+                room.starts = (room.starts + [seconds_of_day(time.time())])[-7:]
+            else:
+                # 刚下播的多半是断流，可能很快重新开播
+                room.hot_until = now + self.hot_period
+        room.interval = self.next_interval(room, now)
+        room.next_check = now + room.interval
+        if changed and self.on_change is not None:
+            try:
+                self.on_change(room.roomid, is_live, info)
+            except Exception:
+                traceback.print_exc()
+        return changed
+
+    def resolve(self, limit):
+        '为还不知道 uid 的直播间查询 uid，顺便得到初始状态；每次最多 limit 个，避免启动时一下子发出几百个请求'
+        now = time.monotonic()
+        with self.lock:
+            pending = [r for r in self.rooms.values() if r.uid is None and r.next_check <= now][:limit]
+        for room in pending:
+            self.requests += 1
+            try:
+                info = live.get_live_info(room.roomid)
+            except RuntimeError as e:
+                # 接口返回错误（直播间不存在等）时退避重试；网络错误照常抛出，由 run() 整体退避
+                room.interval = min(room.interval * 2 or self.min_interval, self.max_interval)
+                room.next_check = time.monotonic() + room.interval
+                print(f'直播间 {room.roomid} 查询失败，{room.interval} 秒后重试：{e}')
+                continue
+            room.uid = info['uid']
+            self.update(room, info, time.monotonic())
+        if pending:
+            self.save_state()
+        return len(pending)
+
+    def check_due(self):
+        '把 slack 秒内到期的直播间分批查询一遍，返回请求次数'
+        now = time.monotonic()
+        with self.lock:
+            due = [r for r in self.rooms.values() if r.uid and r.next_check <= now + self.slack]
+        # 最早到期的优先，保证每批都先照顾等得最久的
+        due.sort(key=lambda r: r.next_check)
+        count = 0
+        for i in range(0, len(due), self.batch_size):
+            batch = due[i:i + self.batch_size]
+            data = live.get_status_info_by_uids([r.uid for r in batch])
+            count += 1
+            self.requests += 1
+            now = time.monotonic()
+            changed = False
+            for room in batch:
+                info = data.get(str(room.uid))
+                if info is None:
+                    # 查不到的直播间按基础间隔再查
+                    room.next_check = now + self.base_interval
+                    continue
+                changed |= self.update(room, info, now)
+            if changed:
+                self.save_state()
+        return count
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                resolving = self.resolve(self.resolve_per_second)
+                # 已查到 uid 的直播间不用等其他直播间全部查完
+                self.check_due()
+                self.backoff = 0
+                if resolving:
+                    self.stopped.wait(1)
+                    continue
+            except Exception:
+                traceback.print_exc()
+                # 被风控或网络出错时整体退避
+                self.backoff = min(self.backoff * 2 or self.min_interval, self.max_interval)
+                self.stopped.wait(self.backoff)
+                continue
+            with self.lock:
+                next_checks = [r.next_check for r in self.rooms.values()]
+            delay = min(next_checks) - time.monotonic() if next_checks else self.base_interval
+            self.stopped.wait(max(delay, 1))
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import http.server
+import threading
+import bisect
+import math
+
+# 关闭时所有 inc/observe 第一行就返回，几乎没有开销
+enabled = False
+
+registry = []
+
+def format_labels(names, values):
+    pairs = list(zip(names, values))
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value != value:
+        return 'NaN'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def label_key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return f'# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}\n'
+
+class Counter(Metric):
+    '只增不减的计数器'
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ''.join(f'{self.name}{format_labels(self.labelnames, key)} {format_value(v)}\n' for key, v in values)
+
+    def summary(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f'{self.name}{format_labels(self.labelnames, key)} = {format_value(v)}' for key, v in values]
+
+class Gauge(Metric):
+    '当前值；传入 func 时在读取时才调用 func 取值，平时不产生任何开销'
+    type = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        super().__init__(name, help)
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        if enabled:
+            self.value = value
+
+    def get(self):
+        if self.func is not None:
+            try:
+                return self.func()
+            except Exception:
+                return math.nan
+        return self.value
+
+    def render(self):
+        return f'{self.name} {format_value(self.get())}\n'
+
+    def summary(self):
+        return [f'{self.name} = {format_value(self.get())}']
+
+class Histogram(Metric):
+    '按 buckets 分桶统计耗时，单位为秒'
+    type = 'histogram'
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, buckets=default_buckets):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        if not enabled:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        '按桶的上界估计分位数'
+        with self.lock:
+            counts = list(self.counts)
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound if bound != math.inf else self.max
+        return self.max
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total_sum = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} {cumulative}\n')
+        lines.append(f'{self.name}_sum {format_value(total_sum)}\n')
+        lines.append(f'{self.name}_count {cumulative}\n')
+        return ''.join(lines)
+
+    def summary(self):
+        count = self.count
+        if count == 0:
+            return [f'{self.name}: 暂无数据']
+        return [f'{self.name}: {count} 次，平均 {self.sum / count * 1000:.1f} ms，'
+                f'p50≤{self.quantile(0.5) * 1000:.1f} ms，p99≤{self.quantile(0.99) * 1000:.1f} ms，最大 {self.max * 1000:.1f} ms']
+
+def render() -> str:
+    'Prometheus 文本格式'
+    return ''.join(m.header() + m.render() for m in registry)
+
+def summary() -> str:
+    '给设置窗口中的调试面板看的简要文本'
+    lines = []
+    for m in registry:
+        lines.extend(m.summary())
+    return '\n'.join(lines)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+server = None
+
+def start_server(port, host='127.0.0.1'):
+    '在后台线程中提供 http://host:port/metrics，只监听本机；已在其他端口上运行时先停掉再重新监听'
+    global server
+    if server is not None:
+        if server.server_address[:2] == (host, port):
+            return server
+        stop_server()
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def stop_server():
+    global server
+    if server is None:
+        return
+    server.shutdown()
+    server.server_close()
+    server = None
@@ -0,0 +1,731 @@
+#!/usr/bin/env python
+
+import urllib.parse
+import urllib.request
+import urllib.error
+import http.server
+import collections
+import traceback
+import threading
+import itertools
+import argparse
+import hashlib
+import random
+import socket
+import struct
+import queue
+import json
+import math
+import zlib
+import time
+import sys
+import re
+
+import danmuws
+import flv
+
+# 录制时按路径把请求转发到对应的真实域名
+UPSTREAMS = [
+    ('/x/passport-login/', 'https://passport.bilibili.com'),
+    ('/x/', 'https://api.bilibili.com'),
+    ('/video/', 'https://www.bilibili.com'),
+    # 头像、表情等图片，i0~i2.hdslb.com 的内容相同
+    ('/bfs/', 'https://i0.hdslb.com'),
+    ('/', 'https://api.live.bilibili.com'),
+]
+
+MOCK_UID = 10000
+MOCK_UNAME = '测试主播'
+
+NICKNAMES = ['小彭老师', '路人甲', '弹幕姬', '今天也要加油', 'C++ 爱好者', '摸鱼中', '不想上班']
+TEXTS = ['666', '主播好', '这个问题怎么解决？', '哈哈哈哈哈哈', '来了来了', 'C++ 的模板元编程', '能再讲一遍吗', '好耶']
+EMOTICONS = ['赞', '妙啊', '打call', '吃瓜', 'awsl']
+
+def make_danmu(rng, seq, now=None):
+    '生成一条 gethistory 格式的弹幕'
+    now = time.time() if now is None else now
+    uid = rng.randint(1, 10 ** 9)
+    medal = []
+    if rng.random() < 0.6:
+        medal = [rng.randint(1, 40), rng.choice(['小彭', '老师', '粉丝团']), MOCK_UNAME, 75287, 0, '', 0, 0, 0, 0, 0, rng.randint(0, 1)]
+    text = rng.choice(TEXTS)
+    emoticon = {'id': 0, 'emoticon_unique': '', 'url': '', 'width': 0, 'height': 0}
+    if rng.random() < 0.05:
+        k = rng.randrange(len(EMOTICONS))
+        text = EMOTICONS[k]
+        emoticon = {'id': k + 1, 'emoticon_unique': f'mock_{k}', 'url': f'https://i0.hdslb.com/bfs/emote/mock-{k}.png', 'width': 64, 'height': 64}
+    return {
+        'text': text,
+        'uid': uid,
+        'nickname': rng.choice(NICKNAMES) + str(uid % 100),
+        'timeline': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+        'id_str': f'{int(now * 1000)}{seq:010d}',
+        'medal': medal,
+        'check_info': {'ts': int(now), 'ct': f'{seq:08X}'},
+        # 头像只有 50 种，方便观察图片缓存的命中情况
+        'user': {'uid': uid, 'base': {'name': '', 'face': f'https://i0.hdslb.com/bfs/face/mock-{uid % 50}.png'}},
+        'emoticon': emoticon,
+    }
+
+def danmu_to_cmd(m):
+    '把 gethistory 格式的弹幕转换成长连接推送的 DANMU_MSG'
+    ts = m['check_info']['ts']
+    return {'cmd': 'DANMU_MSG', 'info': [
+        [0, 1, 25, 0xffffff, ts * 1000, 0, 0, '', 0, 0, 0, '', 0, m.get('emoticon') or '{}', '{}', {'user': m.get('user') or {}}],
+        m['text'],
+        [m['uid'], m['nickname']],
+        m['medal'],
+        [0, 0, 9868950, '>50000', 0],
+        ['', ''],
+        0, 0, None,
+        m['check_info'],
+    ]}
+
+class Room:
+    '一个模拟直播间：最近 10 条弹幕供 gethistory 返回，新弹幕同时推送给所有长连接'
+    def __init__(self, roomid):
+        self.roomid = roomid
+        self.lock = threading.Lock()
+        self.recent = collections.deque(maxlen=10)
+        self.subscribers = []
+        self.title = f'模拟直播间 {roomid}'
+        self.live_status = 0
+        self.area = (2, '网游', 86, '英雄联盟')
+        # 自己的直播间归 MOCK_UID，其他直播间各有各的主播
+        self.uid = MOCK_UID if roomid == 75287 else ROOM_UID_BASE + roomid
+        self.last_flip = time.monotonic()
+
+    def current_status(self):
+        'FLIP_PERIOD 不为 0 时，每个直播间平均每 FLIP_PERIOD 秒随机开播或下播一次，用于测试开播监视'
+        if FLIP_PERIOD:
+            now = time.monotonic()
+            with self.lock:
+                elapsed, self.last_flip = now - self.last_flip, now
+                if random.random() < 1 - math.exp(-elapsed / FLIP_PERIOD):
+                    self.live_status = 1 - self.live_status if self.live_status in (0, 1) else 1
+        return self.live_status
+
+    def publish(self, messages):
+        with self.lock:
+            self.recent.extend(messages)
+            subscribers = list(self.subscribers)
+        if not subscribers:
+            return
+        # 压缩一次，所有连接共用同一个数据包
+        inner = b''.join(danmuws.make_packet(danmuws.OP_MESSAGE, danmu_to_cmd(m), danmuws.VER_PLAIN) for m in messages)
+        packet = danmuws.make_packet(danmuws.OP_MESSAGE, zlib.compress(inner), danmuws.VER_ZLIB)
+        for q in subscribers:
+            try:
+                q.put_nowait(packet)
+            except queue.Full:
+                stats.inc('push_dropped', len(messages))
+
+    def history(self):
+        with self.lock:
+            return list(self.recent)
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.started = time.time()
+
+    def inc(self, key, amount=1):
+        with self.lock:
+            self.counts[key] += amount
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return {'uptime': time.time() - self.started, 'counts': counts}
+
+stats = Stats()
+
+class MockState:
+    def __init__(self, port, broadcast_port, recording=None, send_interval=1.0):
+        self.port = port
+        self.broadcast_port = broadcast_port
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.replies = {}
+        self.last_send = {}
+        self.send_interval = send_interval
+        self.seq = 0
+        if recording:
+            self.load_replies(recording)
+
+    def room(self, roomid):
+        roomid = int(roomid)
+        with self.lock:
+            room = self.rooms.get(roomid)
+            if room is None:
+                room = self.rooms[roomid] = Room(roomid)
+            return room
+
+    def next_seq(self):
+        with self.lock:
+            self.seq += 1
+            return self.seq
+
+    def load_replies(self, path):
+        '回放模式：除 gethistory 以外的接口按 (方法, 路径, 参数) 返回录制时的最后一次响应'
+        for entry in read_recording(path):
+            if '/dM/gethistory' in entry['path']:
+                continue
+            url = urllib.parse.urlsplit(entry['path'])
+            self.replies[(entry['method'], url.path, url.query)] = entry
+            self.replies.setdefault((entry['method'], url.path, None), entry)
+
+def read_recording(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def recorded_danmu(path):
+    '从录制文件中取出所有 gethistory 返回过的弹幕，去重后按时间排序'
+    seen = {}
+    for entry in read_recording(path):
+        if '/dM/gethistory' not in entry['path']:
+            continue
+        try:
+            room = json.loads(entry['body'])['data']['room']
+        except (ValueError, KeyError, TypeError):
+            continue
+        for m in room:
+            key = m.get('id_str') or (m['uid'], m['timeline'], m['text'])
+            seen.setdefault(key, m)
+    messages = list(seen.values())
+    messages.sort(key=lambda m: (m.get('check_info') or {}).get('ts') or m['timeline'])
+    return messages
+
+class DanmuSource(threading.Thread):
+    '''按给定速率往所有直播间发弹幕
+
+    rate 为每秒条数；指定了 replay 时依次回放录制的弹幕（rate 为 0 时按录制时的间隔，乘以 speed），
+    否则随机生成。每 tick 秒检查一次到期的条数，高速率时一次批量发出
+    '''
+    def __init__(self, state, rate, replay=None, speed=1.0, tick=0.01, seed=0):
+        super().__init__(daemon=True)
+        self.state = state
+        self.rate = rate
+        self.replay = replay
+        self.speed = speed
+        self.tick = tick
+        self.rng = random.Random(seed)
+
+    def run(self):
+        if self.replay and not self.rate:
+            self.run_recorded_timing()
+            return
+        started = time.monotonic()
+        emitted = 0
+        while True:
+            time.sleep(self.tick)
+            due = int((time.monotonic() - started) * self.rate) - emitted
+            if due <= 0:
+                continue
+            emitted += due
+            self.emit(due)
+
+    def next_message(self, now):
+        seq = self.state.next_seq()
+        if not self.replay:
+            return make_danmu(self.rng, seq, now)
+        m = dict(self.replay[seq % len(self.replay)])
+        # 循环回放时弹幕 id 不能重复，时间也改成现在
+        m['id_str'] = f'{int(now * 1000)}{seq:010d}'
+        m['timeline'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+        m['check_info'] = {'ts': int(now), 'ct': f'{seq:08X}'}
+        return m
+
+    def emit(self, count):
+        now = time.time()
+        with self.state.lock:
+            rooms = list(self.state.rooms.values())
+        for room in rooms:
+            room.publish([self.next_message(now) for _ in range(count)])
+        stats.inc('danmu_generated', count * len(rooms))
+
+    def run_recorded_timing(self):
+        while True:
+            last_ts = None
+            for m in self.replay:
+                ts = (m.get('check_info') or {}).get('ts')
+                if ts and last_ts:
+                    time.sleep(max(ts - last_ts, 0) / self.speed)
+                last_ts = ts or last_ts
+                self.emit(1)
+
+def broadcast_server(state):
+    '模拟弹幕长连接服务器，协议和 danmuws.DanmuClient 一致'
+    def handle(conn):
+        send_lock = threading.Lock()
+        outbox = queue.Queue(maxsize=1000)
+        room = None
+        try:
+            for op, body in danmuws.parse_packets(danmuws.recv_packet(conn)):
+                if op != danmuws.OP_AUTH:
+                    return
+                room = state.room(json.loads(body)['roomid'])
+            conn.sendall(danmuws.make_packet(danmuws.OP_AUTH_REPLY, {'code': 0}))
+            with room.lock:
+                room.subscribers.append(outbox)
+            stats.inc('push_connections')
+
+            def reader():
+                try:
+                    while True:
+                        for op, _ in danmuws.parse_packets(danmuws.recv_packet(conn)):
+                            if op == danmuws.OP_HEARTBEAT:
+                                with send_lock:
+                                    conn.sendall(danmuws.make_packet(danmuws.OP_HEARTBEAT_REPLY, struct.pack('>I', 1)))
+                except (ConnectionError, OSError):
+                    outbox.put(None)
+            threading.Thread(target=reader, daemon=True).start()
+            while True:
+                packet = outbox.get()
+                if packet is None:
+                    break
+                with send_lock:
+                    conn.sendall(packet)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if room is not None:
+                with room.lock:
+                    if outbox in room.subscribers:
+                        room.subscribers.remove(outbox)
+            conn.close()
+
+    server = socket.create_server(('127.0.0.1', state.broadcast_port))
+    state.broadcast_port = server.getsockname()[1]
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=[conn], daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+
+def media_bytes(name, start, end):
+    '按文件名确定的伪随机内容，同一个文件的任意区间每次请求都一样，可用来校验下载结果'
+    block = 65536
+    out = bytearray()
+    for index in range(start // block, (end - 1) // block + 1):
+        seed = hashlib.sha256(f'{name}:{index}'.encode()).digest()
+        data = (seed * (block // len(seed) + 1))[:block]
+        lo = max(start - index * block, 0)
+        hi = min(end - index * block, block)
+        out += data[lo:hi]
+    return bytes(out)
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: MockState = None
+    recorder = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def dispatch(self, method):
+        stats.inc('requests')
+        url = urllib.parse.urlsplit(self.path)
+        self.query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        self.form = {}
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            self.raw_body = self.rfile.read(length)
+            self.form = {k: v[-1] for k, v in urllib.parse.parse_qs(self.raw_body.decode()).items()}
+        try:
+            if self.recorder is not None:
+                self.proxy(method)
+                return
+            reply = self.state.replies.get((method, url.path, url.query)) or self.state.replies.get((method, url.path, None))
+            if reply is not None and not url.path.startswith('/mock/'):
+                stats.inc('replayed')
+                self.send_body(reply['body'].encode(), reply.get('status', 200), reply.get('content_type', 'application/json'))
+                return
+            for pattern, handler in ROUTES:
+                m = re.fullmatch(pattern, url.path)
+                if m:
+                    stats.inc(handler.__name__)
+                    handler(self, *m.groups())
+                    return
+            self.send_json({'code': -404, 'message': '啥都木有', 'data': None}, 404)
+        except (ConnectionError, OSError):
+            pass
+        except Exception:
+            traceback.print_exc()
+            self.send_json({'code': -500, 'message': '模拟服务器内部错误', 'data': None}, 500)
+
+    def send_body(self, body, status=200, content_type='application/json; charset=utf-8', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, data, status=200, headers=()):
+        self.send_body(json.dumps(data, ensure_ascii=False).encode(), status, headers=headers)
+
+    def ok(self, data, headers=()):
+        self.send_json({'code': 0, 'message': '0', 'ttl': 1, 'data': data}, headers=headers)
+
+    def fail(self, code, message):
+        self.send_json({'code': code, 'message': message, 'data': None})
+
+    def base_url(self):
+        return f'http://{self.headers.get("Host", f"127.0.0.1:{self.state.port}")}'
+
+    def proxy(self, method):
+        '录制模式：转发到真实接口，把请求和响应追加到录制文件'
+        for prefix, upstream in UPSTREAMS:
+            if self.path.startswith(prefix):
+                break
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in ('host', 'accept-encoding', 'content-length', 'connection')}
+        request = urllib.request.Request(upstream + self.path, data=self.raw_body if method == 'POST' else None,
+                                         headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                status, body, response_headers = response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            status, body, response_headers = e.code, e.read(), e.headers
+        content_type = response_headers.get('Content-Type', 'application/octet-stream')
+        entry = {'time': time.time(), 'method': method, 'path': self.path, 'form': self.form,
+                 'status': status, 'content_type': content_type}
+        if content_type.startswith(('application/json', 'text/')):
+            entry['body'] = body.decode('utf-8', errors='replace')
+        else:
+            entry['size'] = len(body)
+        self.recorder(entry)
+        # 真实接口的 cookie 限定在 .bilibili.com，去掉 Domain 才能在本机地址上生效
+        cookies = [('Set-Cookie', re.sub(r';\s*Domain=[^;]*', '', v, flags=re.I)) for v in response_headers.get_all('Set-Cookie') or []]
+        self.send_body(body, status, content_type, cookies)
+
+    # ---- 账号 ----
+
+    def nav(self):
+        self.ok({'isLogin': True, 'mid': MOCK_UID, 'uname': MOCK_UNAME,
+                 'wbi_img': {'img_url': 'https://i0.hdslb.com/bfs/wbi/7cd084941338484aae1ad9425b84077c.png',
+                             'sub_url': 'https://i0.hdslb.com/bfs/wbi/4932caff0ff746eab6f01bf08b70ac45.png'}})
+
+    def qrcode_generate(self):
+        key = hashlib.md5(str(time.time()).encode()).hexdigest()
+        self.ok({'url': f'https://passport.bilibili.com/h5-app/passport/login/scan?qrcode_key={key}', 'qrcode_key': key})
+
+    def qrcode_poll(self):
+        # 扫码一律立即成功
+        cookies = [('Set-Cookie', f'{k}={v}; Path=/') for k, v in
+                   (('SESSDATA', 'mock-sessdata'), ('bili_jct', 'mockcsrf'), ('DedeUserID', str(MOCK_UID)))]
+        self.ok({'url': '', 'refresh_token': '', 'timestamp': int(time.time() * 1000), 'code': 0, 'message': ''}, cookies)
+
+    # ---- 直播间 ----
+
+    def room_info_old(self):
+        mid = int(self.query.get('mid', MOCK_UID))
+        room = self.state.room(75287 if mid == MOCK_UID else mid)
+        self.ok({'roomStatus': 1, 'roundStatus': 0, 'liveStatus': room.live_status, 'url': f'https://live.bilibili.com/{room.roomid}',
+                 'title': room.title, 'cover': '', 'online': 0, 'roomid': room.roomid})
+
+    def danmu_info(self):
+        self.state.room(self.query.get('id', 0))
+        self.ok({'group': 'live', 'token': 'mock-token', 'host_list': [
+            {'host': '127.0.0.1', 'port': self.state.broadcast_port, 'wss_port': 0, 'ws_port': 0}]})
+
+    def gethistory(self):
+        room = self.state.room(self.query.get('roomid', 0))
+        self.ok({'admin': [], 'room': room.history()})
+
+    def send_msg(self):
+        room = self.state.room(self.form.get('roomid', 0))
+        now = time.monotonic()
+        # 和真实接口一样限制发送频率，用于测试 DanmuSender 的退避重试
+        if now - self.state.last_send.get(room.roomid, 0) < self.state.send_interval:
+            stats.inc('send_rate_limited')
+            self.fail(10030, '您发送弹幕的频率过快')
+            return
+        self.state.last_send[room.roomid] = now
+        m = make_danmu(random.Random(), self.state.next_seq())
+        m.update(uid=MOCK_UID, nickname=MOCK_UNAME, text=self.form.get('msg', ''), medal=[])
+        room.publish([m])
+        self.ok({'mode_info': {'mode': 0, 'show_player_type': 1, 'extra': '{}'}})
+
+    def room_get_info(self):
+        room = self.state.room(self.query.get('room_id', 0))
+        parent_id, parent_name, area_id, area_name = room.area
+        self.ok({'uid': room.uid, 'room_id': room.roomid, 'short_id': 0, 'title': room.title, 'live_status': room.current_status(),
+                 'parent_area_id': parent_id, 'parent_area_name': parent_name, 'area_id': area_id, 'area_name': area_name,
+                 'online': len(room.subscribers), 'live_time': '0000-00-00 00:00:00'})
+
+    def status_info_by_uids(self):
+        uids = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('uids[]', [])
+        if self.command == 'POST':
+            uids = json.loads(self.raw_body or b'{}').get('uids', [])
+        data = {}
+        for uid in uids:
+            uid = int(uid)
+            roomid = 75287 if uid == MOCK_UID else uid - ROOM_UID_BASE
+            if roomid <= 0:
+                continue
+            room = self.state.room(roomid)
+            data[str(uid)] = {'uid': uid, 'room_id': roomid, 'short_id': 0, 'title': room.title, 'uname': f'主播{roomid}',
+                              'live_status': room.current_status(), 'live_time': 0, 'area_v2_name': room.area[3]}
+        # 和真实接口一样，一个都没有时 data 是空列表
+        self.ok(data or [])
+
+    def area_list(self):
+        self.ok([
+            {'id': 2, 'name': '网游', 'list': [{'id': '86', 'parent_id': '2', 'parent_name': '网游', 'name': '英雄联盟'}]},
+            {'id': 11, 'name': '知识', 'list': [{'id': '376', 'parent_id': '11', 'parent_name': '知识', 'name': '科学科普'},
+                                              {'id': '372', 'parent_id': '11', 'parent_name': '知识', 'name': '科技'}]},
+        ])
+
+    def room_update(self):
+        room = self.state.room(self.form.get('room_id', 0))
+        room.title = self.form.get('title', room.title)
+        self.ok([])
+
+    def start_live(self):
+        room = self.state.room(self.form.get('room_id', 0))
+        room.live_status = 1
+        self.ok({'change': 1, 'status': 'LIVE', 'rtmp': {'addr': 'rtmp://127.0.0.1/live-bvc/', 'code': 'mock-stream-key'}})
+
+    def stop_live(self):
+        room = self.state.room(self.form.get('room_id', 0))
+        room.live_status = 0
+        self.ok({'change': 1, 'status': 'PREPARING'})
+
+    def play_url(self):
+        cid = self.query.get('cid', 0)
+        self.ok({'current_quality': 4, 'durl': [{'url': f'{self.base_url()}/mock/live/{cid}.flv', 'order': 1}]})
+
+    def live_stream(self, cid):
+        '''无限长的 FLV 直播流，每秒 25 帧、每 2 秒一个关键帧，按 --live-bitrate 匀速发送；
+        设置了 --live-cut 时像 CDN 一样在若干秒后断开'''
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/x-flv')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        fps = 25
+        frame = max(LIVE_BITRATE // 8 // fps - 400, 16)
+        self.wfile.write(flv.FLV_HEADER
+                         + flv.make_tag(flv.TAG_SCRIPT, 0, b'\x02\x00\x0aonMetaData\x08\x00\x00\x00\x00\x00\x00\x09')
+                         + flv.make_tag(flv.TAG_VIDEO, 0, b'\x17\x00\x00\x00\x00' + media_bytes(f'avcc-{cid}', 0, 32))
+                         + flv.make_tag(flv.TAG_AUDIO, 0, b'\xaf\x00\x12\x10'))
+        started = time.monotonic()
+        offset = 0
+        for i in itertools.count():
+            if LIVE_CUT and time.monotonic() - started > LIVE_CUT:
+                stats.inc('live_cut')
+                return
+            timestamp = i * 1000 // fps
+            video = b'\x17' if i % (2 * fps) == 0 else b'\x27'
+            body = media_bytes(f'live-{cid}', offset, offset + frame)
+            offset += frame
+            self.wfile.write(flv.make_tag(flv.TAG_VIDEO, timestamp, video + b'\x01\x00\x00\x00' + body)
+                             + flv.make_tag(flv.TAG_AUDIO, timestamp, b'\xaf\x01' + body[:398]))
+            stats.inc('live_bytes', frame + 400)
+            delay = started + (i + 1) / fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    # ---- 视频 ----
+
+    def pagelist(self):
+        bvid = self.query.get('bvid', '')
+        self.ok([{'cid': int(hashlib.md5(bvid.encode()).hexdigest()[:8], 16), 'page': 1, 'part': f'{bvid} 模拟视频',
+                  'duration': 300, 'dimension': {'width': 1920, 'height': 1080, 'rotate': 0}}])
+
+    def playinfo(self, bvid):
+        base = self.base_url()
+        return {'code': 0, 'message': '0', 'data': {
+            'quality': 80,
+            'durl': [{'order': 1, 'length': 300000, 'size': MEDIA_SIZE, 'url': f'{base}/mock/media/{bvid}.mp4'}],
+            'dash': {'duration': 300, 'video': [
+                {'id': 80, 'baseUrl': f'{base}/mock/media/{bvid}-video.m4s', 'width': 1920, 'height': 1080, 'frameRate': '30', 'bandwidth': 2000000}],
+                'audio': [
+                {'id': 30280, 'baseUrl': f'{base}/mock/media/{bvid}-audio.m4s', 'bandwidth': 320000}]},
+        }}
+
+    def player_playurl(self):
+        self.send_json(self.playinfo(self.query.get('bvid', '')))
+
+    def video_page(self, bvid):
+        # download.py 从页面里用正则提取 __playinfo__ 和标题
+        page = (f'<html><head><script>window.__playinfo__={json.dumps(self.playinfo(bvid))}</script><script>'
+                f'</script></head><body><h1 title="{bvid} 模拟视频" class="video-title" data-v-1></h1></body></html>')
+        self.send_body(page.encode(), content_type='text/html; charset=utf-8')
+
+    def media(self, name):
+        '支持 Range 的媒体文件，大小由 --media-size 或 ?size= 指定'
+        size = int(self.query.get('size', MEDIA_SIZE))
+        start, end = 0, size
+        status = 200
+        headers = [('Accept-Ranges', 'bytes')]
+        m = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if m:
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)) + 1, size) if m.group(2) else size
+            else:
+                start = max(size - int(m.group(2)), 0)
+            if start >= size:
+                self.send_body(b'', 416, 'video/mp4', [('Content-Range', f'bytes */{size}')])
+                return
+            status = 206
+            headers.append(('Content-Range', f'bytes {start}-{end - 1}/{size}'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        for offset in range(start, end, 1 << 20):
+            self.wfile.write(media_bytes(name, offset, min(offset + (1 << 20), end)))
+        stats.inc('media_bytes', end - start)
+
+    def image(self, kind, name):
+        '头像和表情：按文件名决定颜色的纯色 PNG'
+        color = hashlib.md5(name.encode()).digest()[:3]
+        self.send_body(solid_png(64, 64, color), content_type='image/png', headers=[('Cache-Control', 'max-age=86400')])
+
+    def fav_list(self):
+        media_id = self.query.get('media_id', '0')
+        ps, pn = int(self.query.get('ps', 20)), int(self.query.get('pn', 1))
+        total = 45
+        medias = [{'title': f'收藏夹 {media_id} 视频 {i}', 'bvid': f'BV1mock{media_id}x{i}', 'cover': ''}
+                  for i in range((pn - 1) * ps, min(pn * ps, total))]
+        self.ok({'info': {'id': int(media_id), 'media_count': total}, 'medias': medias, 'has_more': pn * ps < total})
+
+    def dynamic_feed(self):
+        offset = int(self.query.get('offset') or 0)
+        items = []
+        for i in range(offset, offset + 12):
+            major = {'type': 'MAJOR_TYPE_ARCHIVE', 'archive': {'jump_url': f'//www.bilibili.com/video/BV1mock{i}'}}
+            if i % 3 == 1:
+                major = {'type': 'MAJOR_TYPE_DRAW', 'draw': {'items': [{'src': f'https://i0.hdslb.com/bfs/mock/{i}.jpg'}]}}
+            elif i % 3 == 2:
+                major = None
+            items.append({'id_str': str(900000000 + i), 'modules': {'module_dynamic': {'desc': {'text': f'模拟动态 {i}'}, 'major': major}}})
+        self.ok({'items': items, 'offset': str(offset + 12), 'has_more': offset + 12 < 60})
+
+    def mock_stats(self):
+        self.send_json(stats.snapshot())
+
+ROUTES = [
+    (r'/x/web-interface/nav', MockHandler.nav),
+    (r'/x/passport-login/web/qrcode/generate', MockHandler.qrcode_generate),
+    (r'/x/passport-login/web/qrcode/poll', MockHandler.qrcode_poll),
+    (r'/room/v1/Room/getRoomInfoOld', MockHandler.room_info_old),
+    (r'/xlive/web-room/v1/index/getDanmuInfo', MockHandler.danmu_info),
+    (r'/xlive/web-room/v1/dM/gethistory', MockHandler.gethistory),
+    (r'/msg/send', MockHandler.send_msg),
+    (r'/room/v1/Room/get_info', MockHandler.room_get_info),
+    (r'/room/v1/Room/get_status_info_by_uids', MockHandler.status_info_by_uids),
+    (r'/room/v1/Area/getList', MockHandler.area_list),
+    (r'/room/v1/Room/update', MockHandler.room_update),
+    (r'/room/v1/Room/startLive', MockHandler.start_live),
+    (r'/room/v1/Room/stopLive', MockHandler.stop_live),
+    (r'/room/v1/Room/playUrl', MockHandler.play_url),
+    (r'/mock/live/(\w+)\.flv', MockHandler.live_stream),
+    (r'/x/player/pagelist', MockHandler.pagelist),
+    (r'/x/player/playurl', MockHandler.player_playurl),
+    (r'/video/(\w+)/?', MockHandler.video_page),
+    (r'/mock/media/([\w.-]+)', MockHandler.media),
+    (r'/x/v3/fav/resource/list', MockHandler.fav_list),
+    (r'/x/polymer/web-dynamic/v1/feed/space', MockHandler.dynamic_feed),
+    (r'/bfs/(\w+)/([\w.-]+)', MockHandler.image),
+    (r'/mock/stats', MockHandler.mock_stats),
+]
+
+def solid_png(width, height, rgb):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + bytes(rgb) * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+MEDIA_SIZE = 8 << 20
+ROOM_UID_BASE = 100_000_000
+FLIP_PERIOD = 0
+LIVE_CUT = 0
+LIVE_BITRATE = 4_000_000
+
+def make_recorder(path):
+    lock = threading.Lock()
+    f = open(path, 'a', encoding='utf-8')
+
+    def record(entry):
+        with lock:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+    return record
+
+def serve(port=8000, broadcast_port=0, rate=5.0, record=None, replay=None, speed=1.0, send_interval=1.0):
+    '启动模拟服务器，返回 (HTTP 服务器, 状态)；HTTP 服务在后台线程中运行'
+    state = MockState(port, broadcast_port, recording=replay, send_interval=send_interval)
+    handler = type('Handler', (MockHandler,), {'state': state})
+    if record:
+        handler.recorder = staticmethod(make_recorder(record))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    state.port = server.server_address[1]
+    if not record:
+        broadcast_server(state)
+        messages = recorded_danmu(replay) if replay else None
+        if messages is not None and not messages:
+            print('录制文件中没有弹幕，改为随机生成', file=sys.stderr)
+            messages = None
+        DanmuSource(state, rate, messages, speed).start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def main(argv=None):
+    global MEDIA_SIZE, LIVE_BITRATE, FLIP_PERIOD, LIVE_CUT
+    parser = argparse.ArgumentParser(description='本地模拟的 B 站接口，用于离线测试和压测')
+    parser.add_argument('--port', type=int, default=8000, help='HTTP 端口')
+    parser.add_argument('--broadcast-port', type=int, default=0, help='弹幕长连接端口，默认随机')
+    parser.add_argument('--rate', type=float, default=5, help='每个直播间每秒产生的弹幕数（1~5000）；回放时为 0 表示按录制时的间隔')
+    parser.add_argument('--record', metavar='FILE', help='转发到真实接口，并把会话录制到 FILE')
+    parser.add_argument('--replay', metavar='FILE', help='回放录制的会话')
+    parser.add_argument('--speed', type=float, default=1.0, help='按录制间隔回放时的倍速')
+    parser.add_argument('--send-interval', type=float, default=1.0, help='发送弹幕的最短间隔，过快返回 10030')
+    parser.add_argument('--media-size', type=int, default=MEDIA_SIZE, help='模拟视频文件的大小（字节）')
+    parser.add_argument('--live-bitrate', type=int, default=LIVE_BITRATE, help='模拟直播流的码率（bit/s）')
+    parser.add_argument('--flip-period', type=float, default=0, help='每个直播间平均多少秒随机开播或下播一次，0 为不变')
+    parser.add_argument('--live-cut', type=float, default=0, help='直播流每隔多少秒断开一次，模拟 CDN 地址过期，0 为不断开')
+    args = parser.parse_args(argv)
+    LIVE_CUT = args.live_cut
+    FLIP_PERIOD = args.flip_period
+    MEDIA_SIZE = args.media_size
+    LIVE_BITRATE = args.live_bitrate
+    server, state = serve(args.port, args.broadcast_port, args.rate, args.record, args.replay, args.speed, args.send_interval)
+    mode = '录制' if args.record else '回放' if args.replay else '模拟'
+    print(f'{mode}服务器已启动：http://127.0.0.1:{state.port}  弹幕长连接端口：{state.broadcast_port}')
+    print(f'使用方法：BILI_API_BASE=http://127.0.0.1:{state.port} python danmu.py')
+    try:
+        while True:
+            time.sleep(10)
+            snapshot = stats.snapshot()
+            print(json.dumps(snapshot['counts'], ensure_ascii=False))
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+class DanmuMessage:
+    __slots__ = ('id', 'uid', 'nickname', 'text', 'timestamp', 'medal', 'face', 'emoticon', 'display_cache')
+
+    def __init__(self, id, uid, nickname, text, timestamp, medal=None, face='', emoticon=''):
+        self.id = id
+        self.uid = uid
+        self.nickname = nickname
+        self.text = text
+        self.timestamp = timestamp
+        self.medal = medal  # (等级, 勋章名)，未点亮时为 None
+        self.face = face  # 头像 URL
+        self.emoticon = emoticon  # 表情包弹幕的图片 URL，普通弹幕为空
+        self.display_cache = None
+
+    @classmethod
+    def from_history(cls, m):
+        '从 gethistory 返回的（或长连接转换后的）弹幕构造'
+        check_info = m.get('check_info') or {}
+        timestamp = check_info.get('ts')
+        if not timestamp:
+            timestamp = int(time.mktime(time.strptime(m['timeline'], '%Y-%m-%d %H:%M:%S')))
+        medal = m.get('medal')
+        if medal and len(medal) > 11 and medal[11]:
+            medal = (medal[0], medal[1])
+        else:
+            medal = None
+        # gethistory 和长连接的 DANMU_MSG 都带有同一个 check_info.ct，用它作 id 两边才能互相去重
+        id = check_info.get('ct') or (m['uid'], timestamp, m['text'])
+        face = ((m.get('user') or {}).get('base') or {}).get('face') or ''
+        emoticon = (m.get('emoticon') or {}).get('url') or ''
+        return cls(id, m['uid'], m['nickname'], m['text'], timestamp, medal, face, emoticon)
+
+    def display(self, show_medal=False, show_time=False) -> tuple[str, str]:
+        '格式化为 (用户名, 弹幕)，结果按显示选项缓存'
+        key = (show_medal, show_time)
+        cache = self.display_cache
+        if cache is not None and cache[0] == key:
+            return cache[1]
+        user = self.nickname
+        if show_medal and self.medal:
+            user = f'[{self.medal[0]}|{self.medal[1]}] {user}'
+        if show_time:
+            user = f'{time.strftime("%H:%M:%S", time.localtime(self.timestamp))} {user}'
+        result = (user, self.text)
+        self.display_cache = (key, result)
+        return result
+
+    def __repr__(self):
+        return f'DanmuMessage({self.id!r}, {self.uid!r}, {self.nickname!r}, {self.text!r}, {self.timestamp!r}, {self.medal!r})'
+
+class MessageStore:
+    '''按弹幕 id 去重的有界环形缓冲区，线程安全
+
+    add() 只返回之前没见过的弹幕，version 在每次有新弹幕时递增
+    '''
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.messages: dict[object, DanmuMessage] = {}
+        self.lock = threading.Lock()
+        self.version = 0
+
+    def add(self, messages) -> list[DanmuMessage]:
+        new = []
+        with self.lock:
+            for m in messages:
+                if m.id in self.messages:
+                    continue
+                self.messages[m.id] = m
+                new.append(m)
+            # dict 保持插入顺序，最先插入的就是最旧的
+            while len(self.messages) > self.capacity:
+                del self.messages[next(iter(self.messages))]
+            if new:
+                self.version += 1
+        return new
+
+    def latest(self, count) -> list[DanmuMessage]:
+        with self.lock:
+            messages = list(self.messages.values())
+        return messages[-count:] if count else []
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+            self.version += 1
+
+    def __len__(self):
+        return len(self.messages)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import subprocess
+import traceback
+import threading
+import time
+import sys
+import re
+
+def list_window_titles() -> list[str]:
+    '枚举所有窗口标题，只在没有 X11 事件订阅时作为后备使用'
+    try:
+        import pywinctl
+    except ImportError:
+        if sys.platform != 'linux':
+            return []
+        with subprocess.Popen(['wmctrl', '-l'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as p:
+            stdout, _ = p.communicate()
+        titles = []
+        for line in stdout.decode(errors='replace').splitlines():
+            # 0x02000003  3 archer 终端
+            m = re.match(r'^0x([0-9a-f]+)\s+(\d+)\s+(.*?)\s+(.*)$', line)
+            if m:
+                titles.append(m.group(4).strip())
+        return titles
+    else:
+        from ewmhlib import EwmhWindow
+        if EwmhWindow.getName.__name__ != 'ewmhFixedGetName':
+            def ewmhFixedGetName(self):
+                from ewmhlib.Props._props import Window
+                from ewmhlib import getPropertyValue
+                ret = self.getProperty(Window.NAME)
+                res = getPropertyValue(ret, display=self.display)
+                if res:
+                    return ''.join(map(str, res))
+                ret = self.getProperty(Window.LEGACY_NAME)
+                res = getPropertyValue(ret, display=self.display)
+                if res:
+                    return ''.join(map(str, res))
+                return None
+            EwmhWindow.getName = ewmhFixedGetName
+        return [win.title for win in pywinctl.getAllWindows()]
+
+class NowPlaying:
+    '''当前播放的音乐名，由后台线程在窗口标题或 MPRIS 元数据变化时更新
+
+    get() 只返回缓存的结果。依次尝试：
+    - MPRIS：订阅会话总线上的 PropertiesChanged 和 NameOwnerChanged 信号（需要 jeepney），同样经过 musicRegex 过滤
+    - X11：订阅 _NET_CLIENT_LIST 和各窗口 WM_NAME 的 PropertyNotify 事件（需要 python-xlib）
+    - 都不可用时，每隔 poll_interval 秒枚举一次窗口标题，set_active(False) 后暂停枚举
+    '''
+    def __init__(self, regex, poll_interval=5):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.window_titles = []
+        self.window_title = ''
+        self.mpris_title = ''
+        self.mpris_players = {}  # 播放器的唯一总线名 -> {'identity', 'status', 'title'}
+        self.started = False
+        self.active = threading.Event()
+        self.active.set()
+        self.set_regex(regex)
+
+    def set_regex(self, regex):
+        try:
+            self.regex = re.compile(regex) if regex else None
+        except re.error:
+            # 设置界面中正在输入的正则可能还不完整
+            self.regex = None
+        self.update_windows(self.window_titles)
+        self.update_mpris()
+
+    def set_active(self, active):
+        '没有人需要音乐名时暂停轮询窗口标题，事件订阅本身不占用 CPU，不用停'
+        if active:
+            self.active.set()
+        else:
+            self.active.clear()
+
+    def get(self) -> str:
+        return self.mpris_title or self.window_title
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        threading.Thread(target=self.mpris_worker, daemon=True).start()
+        threading.Thread(target=self.window_worker, daemon=True).start()
+
+    def match(self, title):
+        if self.regex is None or not self.regex.search(title):
+            return ''
+        title = self.regex.sub('', title).strip()
+        if title.endswith('.mp4'):
+            title = title[:-len('.mp4')]
+        return title
+
+    def update_windows(self, titles):
+        with self.lock:
+            self.window_titles = titles
+            for title in titles:
+                title = self.match(title)
+                if title:
+                    break
+            else:
+                title = ''
+            self.window_title = title
+
+    def window_worker(self):
+        try:
+            self.x11_worker()
+            return
+        except ImportError:
+            pass
+        except Exception:
+            traceback.print_exc()
+        while True:
+            self.active.wait()
+            try:
+                self.update_windows(list_window_titles())
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.poll_interval)
+
+    def x11_worker(self):
+        from Xlib import X, Xatom, error
+        from Xlib.display import Display
+        display = Display()
+        root = display.screen().root
+        NET_CLIENT_LIST = display.intern_atom('_NET_CLIENT_LIST')
+        NET_WM_NAME = display.intern_atom('_NET_WM_NAME')
+        UTF8_STRING = display.intern_atom('UTF8_STRING')
+        windows = {}
+
+        def get_title(win):
+            try:
+                prop = win.get_full_property(NET_WM_NAME, UTF8_STRING)
+                if prop and prop.value:
+                    value = prop.value
+                    return value.decode(errors='replace') if isinstance(value, bytes) else str(value)
+                name = win.get_wm_name()
+                if isinstance(name, bytes):
+                    name = name.decode(errors='replace')
+                return name or ''
+            except error.XError:
+                return ''
+
+        def refresh_clients():
+            prop = root.get_full_property(NET_CLIENT_LIST, X.AnyPropertyType)
+            ids = list(prop.value) if prop else []
+            for wid in ids:
+                if wid not in windows:
+                    win = display.create_resource_object('window', wid)
+                    try:
+                        win.change_attributes(event_mask=X.PropertyChangeMask)
+                    except error.XError:
+                        continue
+                    windows[wid] = get_title(win)
+            for wid in set(windows) - set(ids):
+                del windows[wid]
+            return ids
+
+        root.change_attributes(event_mask=X.PropertyChangeMask)
+        order = refresh_clients()
+        self.update_windows([windows[wid] for wid in order if wid in windows])
+        while True:
+            event = display.next_event()
+            if event.type != X.PropertyNotify:
+                continue
+            if event.window.id == root.id and event.atom == NET_CLIENT_LIST:
+                order = refresh_clients()
+            elif event.atom in (NET_WM_NAME, Xatom.WM_NAME) and event.window.id in windows:
+                windows[event.window.id] = get_title(event.window)
+            else:
+                continue
+            self.update_windows([windows[wid] for wid in order if wid in windows])
+
+    def update_mpris(self):
+        '''从正在播放的 MPRIS 播放器中选出音乐名
+
+        和窗口标题一样要经过 musicRegex：按“标题 - 播放器名”（如“xxx - VLC media player”）匹配，
+        这样浏览器里的视频等不想显示的播放器不会盖过用户设置的正则
+        '''
+        with self.lock:
+            for player in list(self.mpris_players.values()):
+                if player['status'] == 'Playing' and player['title']:
+                    title = self.match(f'{player["title"]} - {player["identity"]}')
+                    if title:
+                        break
+            else:
+                title = ''
+            self.mpris_title = title
+
+    def mpris_worker(self):
+        try:
+            from jeepney import MatchRule, HeaderFields, Properties, DBusAddress, message_bus
+            from jeepney.io.blocking import open_dbus_connection, Proxy
+        except ImportError:
+            return
+        try:
+            conn = open_dbus_connection(bus='SESSION')
+            bus = Proxy(message_bus, conn)
+            bus.AddMatch(MatchRule(type='signal', interface='org.freedesktop.DBus.Properties',
+                                   member='PropertiesChanged', path='/org/mpris/MediaPlayer2'))
+            owner_rule = MatchRule(type='signal', sender='org.freedesktop.DBus', interface='org.freedesktop.DBus',
+                                   member='NameOwnerChanged')
+            owner_rule.add_arg_condition(0, 'org.mpris.MediaPlayer2', kind='namespace')
+            bus.AddMatch(owner_rule)
+
+            def get_property(sender, interface, name, default):
+                address = DBusAddress('/org/mpris/MediaPlayer2', bus_name=sender, interface=interface)
+                try:
+                    return conn.send_and_get_reply(Properties(address).get(name), timeout=2).body[0][1]
+                except Exception:
+                    return default
+
+            with conn.filter(MatchRule(type='signal')) as signals:
+                while True:
+                    msg = conn.recv_until_filtered(signals)
+                    fields = msg.header.fields
+                    member = fields.get(HeaderFields.member)
+                    if member == 'NameOwnerChanged':
+                        # 播放器退出时清掉它的音乐名
+                        _, old_owner, new_owner = msg.body
+                        if old_owner and not new_owner and self.mpris_players.pop(old_owner, None) is not None:
+                            self.update_mpris()
+                        continue
+                    if member != 'PropertiesChanged' or fields.get(HeaderFields.path) != '/org/mpris/MediaPlayer2':
+                        continue
+                    sender = fields.get(HeaderFields.sender)
+                    _, changed, _ = msg.body
+                    player = self.mpris_players.get(sender)
+                    if player is None:
+                        # 第一次收到这个播放器的信号，查出它的名字和当前状态
+                        player = {
+                            'identity': get_property(sender, 'org.mpris.MediaPlayer2', 'Identity', ''),
+                            'status': get_property(sender, 'org.mpris.MediaPlayer2.Player', 'PlaybackStatus', 'Stopped'),
+                            'title': self.format_metadata(get_property(sender, 'org.mpris.MediaPlayer2.Player', 'Metadata', {})),
+                        }
+                        self.mpris_players[sender] = player
+                    # 先更新元数据再看播放状态，同一个信号里带着 Paused 时不会又把音乐名放回去
+                    if 'Metadata' in changed:
+                        player['title'] = self.format_metadata(changed['Metadata'][1])
+                    if 'PlaybackStatus' in changed:
+                        player['status'] = changed['PlaybackStatus'][1]
+                    self.update_mpris()
+        except Exception:
+            traceback.print_exc()
+
+    @staticmethod
+    def format_metadata(metadata):
+        title = metadata.get('xesam:title', ('s', ''))[1]
+        artists = metadata.get('xesam:artist', ('as', []))[1]
+        if title and artists:
+            return f'{title} - {", ".join(artists)}'
+        return title
+
+if __name__ == '__main__':
+    now_playing = NowPlaying(sys.argv[1] if len(sys.argv) > 1 else '( - VLC media player)$')
+    now_playing.start()
+    last = None
+    while True:
+        title = now_playing.get()
+        if title != last:
+            print(repr(title))
+            last = title
+        time.sleep(0.5)
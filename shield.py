@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import threading
+import time
+import sys
+import os
+import re
+
+# 只由字面量和 . .* .+ .? 组成的正则，可以拆成若干个必须出现的字面量片段
+WILDCARD = re.compile(r'\.[*+?]?')
+METACHARS = set('\\[](){}|^$*+?.')
+
+class AhoCorasick:
+    '多模式字面量匹配自动机，search() 的耗时只和文本长度有关'
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for word in words:
+            self.add(word)
+        self.build()
+
+    def add(self, word):
+        state = 0
+        for ch in word:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = nxt
+        self.output[state].append(word)
+
+    def build(self):
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def search(self, text) -> set[str]:
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+class ShieldMatcher:
+    '''屏蔽词匹配器
+
+    纯字面量的屏蔽词直接放进 Aho-Corasick 自动机；带通配符的屏蔽词取其中最长的字面量片段
+    作为预筛选条件，只有片段命中时才运行对应的正则。其余复杂正则合并成一个正则每次都检查
+    '''
+    def __init__(self, patterns):
+        self.patterns = patterns
+        # 小写后的字面量 -> 原来的屏蔽词，大小写不同的屏蔽词可能对应同一个字面量
+        self.literals: dict[str, list[str]] = {}
+        self.fragment_regexes: dict[str, list[tuple[str, re.Pattern]]] = {}
+        complex_patterns = []
+        for pattern in patterns:
+            key = pattern.lower()
+            if not METACHARS & set(key):
+                self.literals.setdefault(key, []).append(pattern)
+                continue
+            pieces = WILDCARD.split(key)
+            if all(pieces) and not any(METACHARS & set(p) for p in pieces):
+                fragment = max(pieces, key=len)
+                self.fragment_regexes.setdefault(fragment, []).append((pattern, re.compile(key, re.S)))
+            else:
+                complex_patterns.append(pattern)
+        self.automaton = AhoCorasick(set(self.literals) | set(self.fragment_regexes))
+        self.complex_regex = None
+        if complex_patterns:
+            self.complex_regex = re.compile('|'.join(f'(?P<p{i}>{p})' for i, p in enumerate(complex_patterns)), re.I | re.S)
+            self.complex_patterns = complex_patterns
+
+    def search(self, text) -> list[str]:
+        '返回 text 命中的所有屏蔽词'
+        key = text.lower()
+        found = []
+        for hit in self.automaton.search(key):
+            found += self.literals.get(hit, ())
+            for pattern, regex in self.fragment_regexes.get(hit, ()):
+                if regex.search(key):
+                    found.append(pattern)
+        if self.complex_regex is not None:
+            for m in self.complex_regex.finditer(text):
+                found.append(self.complex_patterns[int(m.lastgroup[1:])])
+        return found
+
+def load_patterns(path) -> list[str]:
+    patterns = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                re.compile(line)
+            except re.error:
+                line = re.escape(line)
+            patterns.append(line)
+    return patterns
+
+class ShieldWords:
+    '从屏蔽词文件构建 ShieldMatcher，文件修改后自动重新加载'
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.matcher = ShieldMatcher([])
+        self.mtime = None
+        self.last_check = 0.0
+
+    def set_path(self, path):
+        with self.lock:
+            self.path = path
+            self.mtime = None
+            self.last_check = 0.0
+            self.matcher = ShieldMatcher([])
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self.last_check < self.check_interval:
+            return
+        with self.lock:
+            self.last_check = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns if self.path else None
+            except OSError:
+                mtime = None
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            self.matcher = ShieldMatcher(load_patterns(self.path) if mtime is not None else [])
+
+    def search(self, text) -> list[str]:
+        self.reload_if_changed()
+        return self.matcher.search(text)
+
+if __name__ == '__main__':
+    # python shield.py pinbi.txt 弹幕内容...
+    shield = ShieldWords(sys.argv[1])
+    for text in sys.argv[2:]:
+        print(text, shield.search(text))